@@ -0,0 +1,277 @@
+# This module has the backends of the evaluations: the providers of the atmospheric models and the runners of MOOG
+# (see provider and runner in the user options area of moognmodels.py)
+#
+# A model provider creates the model_in file of MOOG for a set of atmospheric parameters [Teff, logg, [M/H], vt]:
+#   write(atmpar, fout)         writes the model file fout
+#   write_many(atmpars, fouts)  same for several models
+#   clamp(atmpar)               nearest atmospheric parameters for which a model can be created
+#   key()                       list of values that identify the models (part of the key of the MOOG cache)
+#   batch                       True if write_many creates all the models at once (moognmodels.evaluate_many then calls it
+#                               before starting MOOG); otherwise each model is written with write just before its MOOG run
+# A runner runs MOOG (or any code that writes summary_out in MOOG's format) in the scratch directory of a RunContext:
+#   start(ctx)                  starts the run and returns a job, with wait(), done() and kill() methods
+#   key()                       list of values that identify the runner (part of the key of the MOOG cache; for the MOOG
+#                               executable, its modification time and size, so that a rebuilt MOOG is not mistaken for the old one)
+#   parallel                    True if several runs (each one with its own RunContext) may go on at the same time;
+#                               the finite-difference Jacobian and the speculative mode of the solver then run MOOG concurrently
+# Any object with these methods and attributes may be used instead of the classes below.
+import os
+import time
+import shlex
+import shutil
+import subprocess
+import numpy as np
+import interpolator
+from interpolator import make_header, make_footer, model_rows, write_model
+from runcontext import read_par, moogpar
+
+def model_text(atmpar, model):
+    "Complete MOOG model file (bytes) for the depth structure model (ntau x ncols array, columns as in interpolator.py)"
+    strh = make_header(atmpar[0], atmpar[1], atmpar[2], atmpar[3], model.shape[0])
+    strf = make_footer(atmpar[2], atmpar[3])
+    return ('%s%s%s' % (''.join(strh), model_rows(model), ''.join(strf))).encode()
+
+def command_stamp(command):
+    "Real path, modification time and size of the files in a command line (the executable, the script run by an interpreter, ...),"
+    "so that the key of the MOOG cache changes when any of them is rebuilt"
+    stamp = []
+    for k, w in enumerate(shlex.split(command)):
+        fname = shutil.which(w) if k == 0 else w
+        if fname != None and os.path.isfile(fname):
+            st = os.stat(fname)
+            stamp.append('%s %i %i' % (os.path.realpath(fname), st.st_mtime_ns, st.st_size))
+    return stamp
+
+class ModelProvider:
+    "Base class of the model providers: writes the model files returned by model(), one at a time"
+    name = 'custom'
+    batch = False
+
+    def model(self, atmpar):
+        "Complete MOOG model file (bytes) at atmpar"
+        print('%s: model() is not implemented!' % type(self).__name__)
+        raise SystemExit()
+
+    def write(self, atmpar, fout='MODEL'):
+        write_model(self.model(atmpar), fout)
+
+    def write_many(self, atmpars, fouts):
+        for atmpar, fout in zip(atmpars, fouts):
+            self.write(atmpar, fout)
+
+    def clamp(self, atmpar):
+        p = np.array(atmpar, dtype=float)
+        p[3] = max(p[3], 0.)
+        return p
+
+    def key(self):
+        return [self.name, interpolator.format_type]
+
+class NativeModels(ModelProvider):
+    "Castelli/Kurucz models from the native interpolator (interpolator.py), created in this process"
+    "grid: interpolator.ModelGrid instance (if None, the grid is loaded once per process)"
+    name = 'kurucz'
+    batch = True
+
+    def __init__(self, grid=None):
+        self.grid = grid
+
+    def model(self, atmpar):
+        return interpolator.model_file(atmpar, self.grid)
+
+    def write_many(self, atmpars, fouts):
+        "All the models are interpolated in one pass (interpolator.create_models)"
+        if len(atmpars) < 2:
+            return ModelProvider.write_many(self, atmpars, fouts)
+        models = interpolator.create_models(np.array(atmpars, dtype=float), self.grid)
+        for atmpar, model, fout in zip(atmpars, models, fouts):
+            write_model(model_text(atmpar, model), fout)
+
+    def clamp(self, atmpar):
+        p = ModelProvider.clamp(self, atmpar)
+        grid = interpolator.get_grid() if self.grid == None else self.grid
+        p[0], p[1], p[2] = grid.clamp(p[0], p[1], p[2])
+        return p
+
+    def key(self):
+        # the contents of the grid are part of the key, so that a grid extracted again (e.g., with other vturb or alpha) is not
+        # mistaken for the old one
+        grid = interpolator.get_grid() if self.grid == None else self.grid
+        return [self.name, os.path.abspath(grid.path), interpolator.format_type, grid.whichinterp, grid.digits, grid.digest()]
+
+class PythonModels(ModelProvider):
+    "Models from a Python function called in this process (e.g., an interpolator of MARCS models written in Python)"
+    "func: function of atmpar that returns the complete model file (str or bytes) or the depth structure (ntau x ncols array,"
+    "columns as in format_type of interpolator.py); with writes=True, func(atmpar, fout) writes the model file itself"
+    "name: name of the models, part of the key of the MOOG cache (change it when the models change)"
+    "many: optional function of a list of atmpar that returns the list of models at once (then batch is True)"
+    "clamp: optional function that returns the nearest atmospheric parameters for which a model can be created"
+
+    def __init__(self, func, name='python', writes=False, many=None, clamp=None):
+        self.func = func
+        self.name = name
+        self.writes = writes
+        self.many = many
+        self.batch = many != None
+        self.clampfunc = clamp
+
+    def text(self, atmpar, m):
+        if isinstance(m, str):
+            return m.encode()
+        if isinstance(m, bytes):
+            return m
+        return model_text(atmpar, np.asarray(m, dtype=float))
+
+    def model(self, atmpar):
+        return self.text(atmpar, self.func(atmpar))
+
+    def write(self, atmpar, fout='MODEL'):
+        if self.writes == True:
+            self.func(atmpar, fout)
+            if not os.path.isfile(fout):
+                print('%s: model %s was not written!' % (self.name, fout))
+                raise SystemExit()
+        else:
+            write_model(self.model(atmpar), fout)
+
+    def write_many(self, atmpars, fouts):
+        if self.many == None or len(atmpars) < 2:
+            return ModelProvider.write_many(self, atmpars, fouts)
+        for atmpar, m, fout in zip(atmpars, self.many(atmpars), fouts):
+            write_model(self.text(atmpar, m), fout)
+
+    def clamp(self, atmpar):
+        p = ModelProvider.clamp(self, atmpar)
+        return p if self.clampfunc == None else np.array(self.clampfunc(p), dtype=float)
+
+class CommandModels(ModelProvider):
+    "Models from an external program, run once per model"
+    "command: command line with the fields {teff}, {logg}, {metal}, {micro} and {fout} (the model file to be written),"
+    "e.g., 'interpolator.a {teff:.1f} {logg:.3f} {metal:.3f} {micro:.4f} {fout}'"
+    "name: name of the models, part of the key of the MOOG cache (the command itself if None)"
+
+    def __init__(self, command, name=None):
+        self.command = command
+        self.name = command if name == None else name
+
+    def write(self, atmpar, fout='MODEL'):
+        if os.path.isfile(fout):
+            os.remove(fout)
+        args = shlex.split(self.command.format(teff=atmpar[0], logg=atmpar[1], metal=atmpar[2], micro=atmpar[3], fout=fout))
+        proc = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if proc.returncode != 0 or not os.path.isfile(fout):
+            print('%s: model %s was not written (exit status %i)' % (args[0], fout, proc.returncode))
+            print((proc.stderr or proc.stdout)[-2000:])
+            raise SystemExit()
+
+    def key(self):
+        return ModelProvider.key(self) + command_stamp(self.command)
+
+class MoogJob:
+    "A MOOG run started by MoogRunner.start"
+    "After wait(): returncode, stdout and stderr (captured output of MOOG) are available"
+
+    def __init__(self, proc, summary, timeout):
+        self.proc = proc
+        self.summary = summary
+        self.timeout = timeout
+        self.t0 = time.time()
+        self.returncode = None
+        self.stdout = None
+        self.stderr = None
+
+    def done(self):
+        "True if MOOG has finished (does not block)"
+        return self.proc.poll() != None
+
+    def kill(self):
+        self.proc.kill()
+
+    def wait(self):
+        "Waits for MOOG to finish, killing it if the wall-clock timeout is exceeded"
+        "Raises SystemExit if MOOG timed out, failed, or did not write summary_out"
+        if self.returncode != None:
+            return self
+        try:
+            remaining = None if self.timeout == None else max(self.timeout - (time.time() - self.t0), 0.)
+            self.stdout, self.stderr = self.proc.communicate(timeout=remaining)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.stdout, self.stderr = self.proc.communicate()
+            self.returncode = self.proc.returncode
+            raise SystemExit('MOOG: no answer after %.0f s, process killed (%s)' % (self.timeout, self.proc.args[0]))
+        self.returncode = self.proc.returncode
+        if self.returncode != 0:
+            raise SystemExit('MOOG: exit status %i\n%s' % (self.returncode, (self.stderr or self.stdout)[-2000:]))
+        if not os.path.isfile(self.summary):
+            raise SystemExit('MOOG: summary_out %s was not written\n%s' % (self.summary, (self.stdout + self.stderr)[-2000:]))
+        return self
+
+def summary_file(ctx=None):
+    "summary_out of the RunContext ctx (of the batch.par in the current folder if None)"
+    if ctx == None:
+        return read_par(moogpar)[1].get('summary_out', 'a.out')
+    return ctx.summary
+
+class MoogRunner:
+    "Runs the silent mode version of MOOG in a separate process"
+    "path: MOOG command (command-line arguments may follow it)"
+    "timeout: wall-clock limit in seconds for one MOOG run (None for no limit)"
+    parallel = True
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+
+    def start(self, ctx=None):
+        "Starts MOOG in the scratch directory of ctx (in the current folder if None) and returns immediately"
+        summary = summary_file(ctx)
+        # an old summary_out must not be mistaken for the result of this run
+        if os.path.isfile(summary):
+            os.remove(summary)
+        proc = subprocess.Popen(shlex.split(self.path), cwd=None if ctx == None else ctx.dir, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        return MoogJob(proc, summary, self.timeout)
+
+    def key(self):
+        return [self.path] + command_stamp(self.path)
+
+class FinishedJob:
+    "Job of a run done in this process (PythonRunner): finished as soon as it is started"
+
+    def __init__(self, summary):
+        self.summary = summary
+        self.returncode = 0
+
+    def done(self):
+        return True
+
+    def kill(self):
+        pass
+
+    def wait(self):
+        if not os.path.isfile(self.summary):
+            print('summary_out %s was not written!' % self.summary)
+            raise SystemExit()
+        return self
+
+class PythonRunner:
+    "Runs a Python function in this process instead of MOOG (e.g., a Python wrapper of MOOG, or a stand-in for tests)"
+    "func: function of the path of the MOOG input file (batch.par) that writes its summary_out;"
+    "file names in batch.par are relative to the folder of batch.par"
+    "name: name of the runner, part of the key of the MOOG cache"
+    parallel = False
+
+    def __init__(self, func, name='python'):
+        self.func = func
+        self.name = name
+
+    def start(self, ctx=None):
+        summary = summary_file(ctx)
+        if os.path.isfile(summary):
+            os.remove(summary)
+        self.func(moogpar if ctx == None else ctx.par)
+        return FinishedJob(summary)
+
+    def key(self):
+        return [self.name]
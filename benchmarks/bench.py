@@ -0,0 +1,206 @@
+# Benchmarks of Xiru's own overhead, with a synthetic model grid (synthgrid.py) and a MOOG stand-in (fakemoog.py),
+# so that neither the MOOG binary nor the Castelli/Kurucz grid is needed:
+# loading of the grid, create_model (grid point, 1D, 2D and 3D interpolation), parse_moog_out/parse_moog_fe
+# for increasing line-list sizes, make_errors, and a full standard analysis (std_anal_init + converge_main).
+# The results of each benchmark are compared with those in baseline.json, and the timings are reported as ratios to it.
+#
+# $ python benchmarks/bench.py             # runs and compares with the baseline (exit status 1 if a result differs)
+# $ python benchmarks/bench.py --strict    # also fails if a benchmark is slower than the baseline by more than --tolerance
+# $ python benchmarks/bench.py --update    # saves the results and timings of this machine as the new baseline
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+from tempfile import mkdtemp
+from contextlib import redirect_stdout
+from argparse import ArgumentParser
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+import interpolator
+import moognmodels
+import moogcache
+import jacobian
+import surrogate
+import timing
+from parsemoog import MoogRun, parse_moog_out, parse_moog_fe
+from converge_errors import make_errors
+from setup_converge import std_anal_init, cmatrix
+from main_routines_conv import converge_main
+from runcontext import RunContext
+from synthgrid import make_grid
+import fakemoog
+
+# line-list sizes of the parsing benchmarks
+global nlines; nlines = [100, 1000, 10000]
+
+# model interpolation cases: Teff, logg, [M/H] (nodes of the grid: Teff every 250 K, logg every 0.5, see synthgrid.py)
+global modelcases; modelcases = {'create_model_node': [4250., 1.5, -0.5],
+                                 'create_model_1d': [4300., 1.5, -0.5],
+                                 'create_model_2d': [4300., 1.6, -0.5],
+                                 'create_model_3d': [4300., 1.6, -0.55]}
+
+def best_time(fn, mintime=0.2, repeat=3):
+    "Seconds per call of fn: the best of repeat rounds, each one long enough to take about mintime seconds"
+    t0 = time.perf_counter(); fn(); t1 = time.perf_counter() - t0
+    number = max(1, int(mintime/max(t1, 1e-9)))
+    best = t1
+    for r in range(repeat):
+        t0 = time.perf_counter()
+        for i in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - t0)/number)
+    return best
+
+def line_list(n, fout):
+    "Writes a synthetic MOOG line list with n lines (80% Fe I, 20% Fe II)"
+    rng = np.random.default_rng(n)
+    sid = np.where(np.arange(n) % 5 == 4, 26.1, 26.0)
+    wl = np.sort(rng.uniform(4500., 7000., n))
+    ep = np.where(sid == 26.0, rng.uniform(0., 5., n), rng.uniform(2.5, 4., n))
+    gf = rng.uniform(-4., 0., n)
+    ew = rng.uniform(10., 150., n)
+    f = open(fout, 'w')
+    f.write('Lambda, sp, EP, loggf, C6, FP, EW\n')
+    for k in range(n):
+        f.write('%.2f\t%.1f\t%.2f\t%.3f\t0.0\t0.0\t%.1f\n' % (wl[k], sid[k], ep[k], gf[k], ew[k]))
+    f.close()
+
+def setup(workdir):
+    "Creates the grid, the star folder (batch.par and the Arcturus line list of the repository) and points Xiru to them"
+    gridpath = os.path.join(workdir, 'grid') + '/'
+    make_grid(gridpath)
+    stardir = os.path.join(workdir, 'star')
+    os.makedirs(stardir)
+    shutil.copy(os.path.join(os.path.dirname(here), 'batch.par'), stardir)
+    shutil.copy(os.path.join(os.path.dirname(here), 'arcturus.moog'), stardir)
+    interpolator.gridpath = gridpath
+    moognmodels.moogpath = '%s %s' % (sys.executable, os.path.join(here, 'fakemoog.py'))
+    # nothing is taken from (or saved to) the caches and libraries of earlier runs
+    moogcache.cachedir = None
+    jacobian.jacdir = None
+    surrogate.histdir = None
+    timing.jsonl = False
+    return gridpath, stardir
+
+def run_benchmarks(workdir, quick=False):
+    "Returns a dict with the time per call and the result of each benchmark"
+    gridpath, stardir = setup(workdir)
+    res = {}
+    mintime = 0.05 if quick == True else 0.2
+
+    # loading of the grid: text files (first use) and binary copies (later runs)
+    t0 = time.perf_counter()
+    interpolator.ModelGrid(gridpath)
+    res['load_grid_text'] = {'time': time.perf_counter() - t0, 'result': []}
+    grid = interpolator.ModelGrid(gridpath, maxcache=0)
+    res['load_grid_binary'] = {'time': best_time(lambda: interpolator.ModelGrid(gridpath, maxcache=0), mintime), 'result': [grid.teff.shape[0], grid.logg.shape[0]]}
+
+    # model interpolation (without the model cache)
+    for name, p in modelcases.items():
+        m = interpolator.create_model(p[0], p[1], p[2], 1.7, grid)
+        res[name] = {'time': best_time(lambda: interpolator.create_model(p[0], p[1], p[2], 1.7, grid), mintime),
+                     'result': [m[:,0].sum(), m[:,1].sum(), m[:,2].sum(), m[:,3].sum()]}
+    params = np.column_stack((np.linspace(4000., 5000., 50), np.linspace(1.0, 3.0, 50), np.linspace(-1.2, 0.1, 50), np.full(50, 1.5)))
+    m = interpolator.create_models(params, grid)
+    res['create_models_50'] = {'time': best_time(lambda: interpolator.create_models(params, grid), mintime), 'result': [m[:,:,1].sum()]}
+
+    # parsing of MOOG's output
+    for n in nlines:
+        flines = os.path.join(workdir, 'lines%i' % n)
+        fout = os.path.join(workdir, 'summary%i' % n)
+        line_list(n, flines)
+        f = open(fout, 'w')
+        f.write(fakemoog.summary(np.array([4300., 1.6, -0.5, 1.7]), np.genfromtxt(flines, skip_header=1), flines))
+        f.close()
+        ovec = parse_moog_out(-0.5, alpha=False, fin=fout)
+        res['parse_moog_out_%i' % n] = {'time': best_time(lambda: parse_moog_out(-0.5, alpha=False, fin=fout), mintime), 'result': list(ovec)}
+        fe1, fe2 = parse_moog_fe(fout)
+        res['parse_moog_fe_%i' % n] = {'time': best_time(lambda: parse_moog_fe(fout), mintime), 'result': [fe1[:,6].sum(), fe2[:,6].sum()]}
+
+    # uncertainties (Monte Carlo with the default seed)
+    run = MoogRun(os.path.join(workdir, 'summary1000'))
+    dp = make_errors(cmatrix(), run)
+    res['make_errors_1000'] = {'time': best_time(lambda: make_errors(cmatrix(), run), mintime), 'result': list(dp)}
+
+    # full standard analysis with the MOOG stand-in
+    cwd = os.getcwd()
+    os.chdir(stardir)
+    try:
+        ctx = RunContext('batch.par')
+        c0 = list(moognmodels.counts)
+        t0 = time.perf_counter()
+        with redirect_stdout(open(os.devnull, 'w')):
+            p1, Jn, ovec, pn_init, quadr, run = std_anal_init([4300., 1.6, -0.5, 1.7], False, ctx=ctx)
+            pn, qdr, final_jac, run, niter, history = converge_main(p1, Jn, ovec, pn_init, quadr, False, False, run, ctx)
+        t = time.perf_counter() - t0
+        nmoog = moognmodels.counts[1] - c0[1]
+        ctx.cleanup()
+    finally:
+        os.chdir(cwd)
+    res['converge_main'] = {'time': t, 'result': list(pn) + [niter, nmoog]}
+    res['converge_main_per_moog_run'] = {'time': t/nmoog, 'result': []}
+    return res
+
+def compare(res, base, tolerance=0.5, rtol=1e-6):
+    "Prints each benchmark with its ratio to the baseline; returns the names of those with different results and those that are slower"
+    different = []; slower = []
+    print('%-28s %12s %12s %7s  %s' % ('benchmark', 'time', 'baseline', 'ratio', 'result'))
+    for name, r in res.items():
+        b = base.get(name)
+        if b == None:
+            print('%-28s %12.3e %12s %7s  %s' % (name, r['time'], '-', '-', 'new'))
+            continue
+        same = len(r['result']) == len(b['result']) and np.allclose(r['result'], b['result'], rtol=rtol, atol=1e-9, equal_nan=True)
+        ratio = r['time']/b['time']
+        if same == False:
+            different.append(name)
+        if ratio > 1. + tolerance:
+            slower.append(name)
+        print('%-28s %12.3e %12.3e %7.2f  %s%s' % (name, r['time'], b['time'], ratio, 'ok' if same == True else 'DIFFERENT',
+                                                   '  SLOWER' if ratio > 1. + tolerance else ''))
+    return different, slower
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-u', '--update', action='store_true', help='Save the results and timings as the new baseline')
+    parser.add_argument('-b', '--baseline', default=os.path.join(here, 'baseline.json'), help='Baseline file')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.5, help='Allowed slowdown relative to the baseline (0.5: 50%%)')
+    parser.add_argument('-s', '--strict', action='store_true', help='Exit with status 1 if a benchmark is slower than allowed')
+    parser.add_argument('-q', '--quick', action='store_true', help='Shorter timing rounds')
+    args = parser.parse_args()
+
+    workdir = mkdtemp(prefix='xiru_bench_')
+    try:
+        res = run_benchmarks(workdir, args.quick)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    res = timing.jsonable(res)
+
+    if args.update == True:
+        f = open(args.baseline, 'w')
+        json.dump({'machine': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+                   'benchmarks': res}, f, indent=1)
+        f.write('\n')
+        f.close()
+        print('Baseline saved to %s' % args.baseline)
+        raise SystemExit()
+    if not os.path.isfile(args.baseline):
+        print('Baseline %s not found! Run with --update first.' % args.baseline)
+        raise SystemExit(1)
+    f = open(args.baseline, 'r')
+    base = json.load(f)
+    f.close()
+    print('Baseline: %s, Python %s, numpy %s' % (base['machine'], base['python'], base['numpy']))
+    different, slower = compare(res, base['benchmarks'], args.tolerance)
+    if len(different) > 0:
+        print('Results differ from the baseline: %s' % ', '.join(different))
+    if len(slower) > 0:
+        print('Slower than the baseline: %s' % ', '.join(slower))
+    if len(different) > 0 or (args.strict == True and len(slower) > 0):
+        raise SystemExit(1)
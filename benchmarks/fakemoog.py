@@ -0,0 +1,92 @@
+# Deterministic stand-in for MOOG (silent mode, abfind driver), for the benchmarks
+# Like MOOG, it reads batch.par in the current folder, the model (model_in) and the line list (lines_in),
+# and writes summary_out in MOOG's format. The atmospheric parameters are recovered from the temperature structure
+# of the model (see synthgrid.py); the abundances of each line follow the known Jacobian of Xiru's built-in guess (cmatrix),
+# so the observables vanish at ptrue. Abundances are rounded to 3 decimals, as in MOOG's output.
+#
+# $ python fakemoog.py [batch.par]
+import os
+import sys
+import numpy as np
+from scipy.stats import linregress
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthgrid import params_from_temperature
+
+# atmospheric parameters where the observables vanish
+global ptrue; ptrue = np.array([4286., 1.66, -0.52, 1.74])
+
+# response of the observables (EP slope, ionization balance, [M/H] difference, RW slope) to the atmospheric parameters
+global jac; jac = np.array([[-2.41357143e-04, -2.53571429e-02, -1.19523810e-02, 5.75714286e-02],
+                            [ 1.56907143e-03, -3.54476190e-01, -1.75142857e-01, 6.59285714e-02],
+                            [ 2.29500000e-04,  1.87166667e-01, -8.90809524e-01,-4.04142857e-01],
+                            [ 3.14428571e-04, -7.40476190e-03, -5.82380952e-02,-9.94571429e-01]])
+
+global species; species = {8.0: 'O I', 11.0: 'Na I', 12.0: 'Mg I', 13.0: 'Al I', 14.0: 'Si I', 20.0: 'Ca I', 22.0: 'Ti I',
+                           24.0: 'Cr I', 26.0: 'Fe I', 26.1: 'Fe II', 28.0: 'Ni I', 30.0: 'Zn I'}
+global solar; solar = {8.0: 8.69, 11.0: 6.24, 12.0: 7.60, 13.0: 6.45, 14.0: 7.51, 20.0: 6.34, 22.0: 4.95,
+                       24.0: 5.64, 26.0: 7.50, 26.1: 7.50, 28.0: 6.22, 30.0: 4.56}
+
+def read_par(fin):
+    "Options of the MOOG input file"
+    opts = {}
+    f = open(fin, 'r')
+    for line in f:
+        w = line.split()
+        if len(w) >= 2:
+            opts[w[0]] = w[1].strip('\'"')
+    f.close()
+    return opts
+
+def read_model(fin):
+    "Teff, logg, [M/H] and vt of a model written by interpolator.py"
+    f = open(fin, 'r')
+    t = f.read().splitlines()
+    f.close()
+    n = int(t[2].split()[0])
+    i0 = 4 if t[0].strip() == 'KURTYPE' else 3
+    T = np.array([float(r.split()[1]) for r in t[i0:i0+n]])
+    return np.append(params_from_temperature(T), float(t[i0+n].split()[0]))
+
+def summary(p, lines, label=''):
+    "Text of summary_out for the atmospheric parameters p and the line list (N x 7 array)"
+    d = p - ptrue
+    o = np.dot(jac, d) + 0.05*np.dot(jac, d)**2
+    fe = 7.50 + p[2] + o[2]
+    out = ['Abundance Results: MOOG stand-in', 'line list %s' % label,
+           ' Teff = %5.0f  log g = %5.2f  vt = %5.2f  M/H = %5.2f' % (p[0], p[1], p[3], p[2])]
+    for sid in sorted(set(lines[:,1])):
+        s = lines[lines[:,1] == sid]
+        s = s[np.argsort(s[:,0], kind='stable')]
+        wl, ep, gf, ew = s[:,0], s[:,2], s[:,3], s[:,-1]
+        rw = np.log10(ew*1e-3/wl)
+        noise = 0.02*np.sin(wl*7.3)
+        if sid == 26.0:
+            ab = fe + o[0]*(ep - ep.mean()) + o[3]*(rw - rw.mean()) + noise
+        elif sid == 26.1:
+            ab = fe - o[1] + noise
+        else:
+            ab = fe - 7.50 + solar[sid] + 0.1 + noise
+        ab = np.round(ab, 3)
+        n = ab.shape[0]
+        out.append('')
+        out.append('Abundance Results for Species %-8s (input abundance = %7.3f)' % (species[sid], solar[sid]))
+        out.append(' wavelength        ID         EP     logGF     EWin   logRWin   abund    delavg')
+        for k in range(n):
+            out.append('%10.3f%13.5f%11.3f%10.3f%9.2f%10.3f%9.3f%10.3f' % (wl[k], sid, ep[k], gf[k], ew[k], rw[k], ab[k], ab[k] - ab.mean()))
+        out.append('average abundance = %7.3f  std. deviation = %7.3f  #lines = %3i' % (ab.mean(), ab.std(ddof=1) if n > 1 else 0., n))
+        if n > 1:
+            for name, x in [('E.P.', ep), ('R.W.', rw), ('wav.', wl)]:
+                r = linregress(x, ab) if np.ptp(x) > 0 else (0., ab.mean(), 0.)
+                out.append('%s correlation:                  slope = %10.3E  intercept = %7.3f  corr. coeff. = %7.3f' % (name, r[0], r[1], r[2]))
+    return '\n'.join(out) + '\n'
+
+def run(par='batch.par'):
+    opts = read_par(par)
+    p = read_model(opts['model_in'])
+    lines = np.genfromtxt(opts['lines_in'], skip_header=1)
+    f = open(opts['summary_out'], 'w')
+    f.write(summary(p, lines, opts['lines_in']))
+    f.close()
+
+if __name__ == "__main__":
+    run(*sys.argv[1:])
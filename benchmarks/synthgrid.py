@@ -0,0 +1,46 @@
+# Synthetic model grid for the benchmarks, in the format written by kurucz_extractor.cut_extras
+# ('MODEL ntau' line, 'teff logg' line, then one line per depth with RHOX T P XNE ABROSS ACCRAD VTURB),
+# with the same metallicities and file names as the Castelli/Kurucz grid expected by interpolator.py.
+# The temperature structure of each model is a known linear function of (Teff, logg, [M/H]),
+# so that the MOOG stand-in (fakemoog.py) can recover the atmospheric parameters from an interpolated MODEL.
+import os
+import numpy as np
+
+global ntau; ntau = 72
+global names; names = ['am40','am25','am20','am15','am10','am05','ap00','ap02','ap05']
+global metals; metals = [-4.0, -2.5, -2.0, -1.5, -1.0, -0.5, 0.0, 0.2, 0.5]
+global teffs; teffs = np.arange(3500, 6750, 250)
+global loggs; loggs = np.arange(0.0, 5.5, 0.5)
+
+global tau; tau = np.linspace(-6.875, 2.0, ntau)
+# temperature structure: T = Teff*tbase + logg*tlogg + [M/H]*tmetal
+global tbase; tbase = (0.75*(10**tau + 2./3.))**0.25
+global tlogg; tlogg = 20.*np.sin(np.arange(ntau)/10.)
+global tmetal; tmetal = 30.*np.cos(np.arange(ntau)/7.)
+
+def model(teff, logg, metal):
+    "Depth structure (ntau x 7) of the synthetic model"
+    T = teff*tbase + logg*tlogg + metal*tmetal
+    rhox = 10**(tau*0.9 + 0.1*logg + 0.05*metal) * (1 + 1e-5*teff)
+    P = 10**(tau + logg + 0.3*np.cos(teff/900.) + 0.01*metal*metal)
+    xne = 10**(9 + tau + teff/3000. + 0.1*metal*logg)
+    ab = 10**(-3 + 0.5*tau + np.sin(teff/1000. + logg))
+    ac = 10**(-1.4 + 0.1*tau - 0.05*logg*metal)
+    return np.column_stack([rhox, T, P, xne, ab, ac, np.full(ntau, 2.0e5)])
+
+def params_from_temperature(T):
+    "Teff, logg and [M/H] of a model from its temperature structure (inverse of model)"
+    return np.linalg.lstsq(np.column_stack([tbase, tlogg, tmetal]), T, rcond=None)[0]
+
+def make_grid(path):
+    "Writes the synthetic grid files to path"
+    os.makedirs(path, exist_ok=True)
+    for name, metal in zip(names, metals):
+        f = open(os.path.join(path, name), 'w')
+        for teff in teffs:
+            for logg in loggs:
+                f.write('MODEL %i\n' % ntau)
+                f.write('%8s %8s\n' % ('%i.' % teff, '%.5f' % logg))
+                for r in model(teff, logg, metal):
+                    f.write('%.8E %8.1f %.3E %.3E %.3E %.3E %.3E \n' % tuple(r))
+        f.close()
@@ -1,31 +1,76 @@
 # This module has a method for calculating the uncertainties
 import numpy as np
 from scipy.stats import linregress
+import timing
 from parsemoog import parse_moog_fe
 from differential import reference_star
 from setup_converge import cmatrix
 
-def make_errors(C, fin='a.out', diff_analysis=False, usecmatrix=True):
+# === USER OPTIONS AREA ===
+
+# number of Monte Carlo draws of the line abundances
+global ndraws; ndraws = 1000
+
+# seed of the random number generator (None for a different seed in each run)
+global mcseed; mcseed = 12345
+
+# if True, the lines are resampled with replacement (bootstrap) instead of perturbed with a normal distribution
+global bootstrap; bootstrap = False
+
+# === END OF USER OPTIONS AREA ===
+
+def slopes(x, y):
+    "Least-squares slopes of the rows of y against the rows of x"
+    "(nan for rows where all x are equal, e.g. a bootstrap draw that repeats one line)"
+    dx = x - x.mean(axis=-1, keepdims=True)
+    dy = y - y.mean(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (dx*dy).sum(axis=-1)/(dx*dx).sum(axis=-1)
+
+def make_errors(C, fin='a.out', diff_analysis=False, usecmatrix=True, ctx=None, ref=None, n=None, seed=-1, boot=None):
     "Calculates the internal uncertainties of the atmospheric parameters"
+    "fin is the MoogRun at the final parameters (or the summary_out file name)"
+    "ctx is the RunContext of the analysis (used to run the reference star in differential analysis)"
+    "ref: observables of the reference star, as returned by reference_star (taken from reference_star if None)"
+    "n, seed, boot: number of draws, seed and bootstrap mode of the Monte Carlo (ndraws, mcseed and bootstrap if None/-1/None)"
+    if n == None:
+        n = ndraws
+    if seed == -1:
+        seed = mcseed
+    if boot == None:
+        boot = bootstrap
+    rng = np.random.default_rng(seed)
     Cinv = np.linalg.inv(C)
     fe1, fe2 = parse_moog_fe(fin)
     if diff_analysis == False:
         a1 = fe1[:,6]
         a2 = fe2[:,6]
     else:
-        fe1_ref, fe2_ref, ref_metal = reference_star()
+        if ref == None:
+            ref = reference_star(ctx=ctx)
+        fe1_ref, fe2_ref, ref_metal = ref
         a1 = fe1[:,6] - fe1_ref
         a2 = fe2[:,6] - fe2_ref
     ep = fe1[:,2]
     rw = fe1[:,5]
-    deltaion = []
-    mm = []
-    for i in range(1000):
-        stoc = np.random.normal(np.mean(a1), np.std(a1, ddof=1), a1.shape[0])
-        sto2 = np.random.normal(np.mean(a2), np.std(a2, ddof=1), a2.shape[0])
-        deltaion.append((np.mean(a1+stoc)-np.mean(a2+sto2)))
-        mm.append((np.mean(stoc-a1) + np.mean(sto2-a2))*0.5)
-    ovec = -np.array([linregress(ep, a1)[-1], np.std(deltaion, ddof=1), np.std(mm, ddof=1), linregress(rw, a1)[-1]])
+    with timing.phase('errors'):
+        if boot == False:
+            # all draws at once: one row of n_lines random abundances per draw
+            stoc = rng.normal(np.mean(a1), np.std(a1, ddof=1), (n, a1.shape[0]))
+            sto2 = rng.normal(np.mean(a2), np.std(a2, ddof=1), (n, a2.shape[0]))
+            deltaion = np.mean(a1+stoc, axis=1) - np.mean(a2+sto2, axis=1)
+            mm = (np.mean(stoc-a1, axis=1) + np.mean(sto2-a2, axis=1))*0.5
+            sep = linregress(ep, a1)[-1]
+            srw = linregress(rw, a1)[-1]
+        else:
+            # resampling of the lines: the slopes are recomputed for each draw as well
+            i1 = rng.integers(0, a1.shape[0], (n, a1.shape[0]))
+            i2 = rng.integers(0, a2.shape[0], (n, a2.shape[0]))
+            deltaion = np.mean(a1[i1], axis=1) - np.mean(a2[i2], axis=1)
+            mm = (np.mean(a1[i1], axis=1) + np.mean(a2[i2], axis=1))*0.5
+            sep = np.nanstd(slopes(ep[i1], a1[i1]), ddof=1)
+            srw = np.nanstd(slopes(rw[i1], a1[i1]), ddof=1)
+    ovec = -np.array([sep, np.std(deltaion, ddof=1), np.std(mm, ddof=1), srw])
     dp = np.dot(Cinv, ovec)
     if np.any(dp<=0) or usecmatrix==True:
         jac = cmatrix()
@@ -3,8 +3,24 @@ import matplotlib.pyplot as plt
 import numpy as np
 from parsemoog import diff_ovec
 
-def make_dif_feplot(fe1ref, fe2ref, mh, refmh, stdout='a.out'):
+def make_iteration_plot():
+    "Creates the plot of the iteration history (EP slope, Delta_Fe, Delta_M_H and RW slope)"
+    "Returns the function that adds an iteration to it (callback of solver.solve)"
+    fig, ax = plt.subplots(2,2)
+    def add_iteration(counter, pn, ovec):
+        ax[0,0].scatter(counter, ovec[0])
+        ax[0,1].scatter(counter, ovec[1])
+        ax[1,0].scatter(counter, ovec[2])
+        ax[1,1].scatter(counter, ovec[3])
+        ax[0,0].hlines(0.0, 0.0, counter, linestyles='dotted')
+        ax[0,1].hlines(0.0, 0.0, counter, linestyles='dotted')
+        ax[1,0].hlines(0.0, 0.0, counter, linestyles='dotted')
+        ax[1,1].hlines(0.0, 0.0, counter, linestyles='dotted')
+    return add_iteration
+
+def make_dif_feplot(fe1ref, fe2ref, mh, refmh, stdout='a.out', fout='feplot.png'):
     "Plots differential Boltzmann diagrams and saves to disc"
+    "stdout is the summary_out file name or a MoogRun"
     epsl, gpar, mpar, rwsl, dfe1, dfe2, ep1, rw1, rw2, epint, rwint = diff_ovec(stdout, fe1ref, fe2ref, mh, refmh, mkplot=True)
     
     eplim = [0.0, 5.5]
@@ -74,4 +90,4 @@ def make_dif_feplot(fe1ref, fe2ref, mh, refmh, stdout='a.out'):
     	labelbottom=True,
     	labeltop=False)
     
-    plt.savefig('feplot.png', dpi=200)
\ No newline at end of file
+    plt.savefig(fout, dpi=200)
\ No newline at end of file
@@ -6,13 +6,18 @@
 # if you already have a grid interpolator (written in any language),
 # you can, for instance, instruct the run_custom_interpolator to tell the system to run it
 # in any case, a MOOG 'model_in' file must be created in the system
+# the fout variable is the path where the model must be written (it coincides with 'model_in' in the MOOG input file)
+# then set provider = 'custom' in the user options area of moognmodels.py
+# if your interpolator is a Python function, or a program that takes the parameters as command-line arguments,
+# you do not need this module: see PythonModels and CommandModels in backends.py
 
-def run_custom_interpolator(atmparam):
+def run_custom_interpolator(atmparam, fout='MODEL'):
     # example:
     # if the user has a code called 'interpolator.a' that
     # interpolates the atmospheric model from some grid on some 'model_in' file defined in the MOOG input file
-    # and uses the atmospheric parameters teff logg metal micro as command-line arguments
+    # and uses the atmospheric parameters teff logg metal micro and the output file as command-line arguments
     # write:
     # import os
-    # os.system('interpolator.a %.1f %.3f %.3f %.4f' % (atmparam[0], atmparam[1], atmparam[2], atmparam[3]))
-    return void
\ No newline at end of file
+    # os.system('interpolator.a %.1f %.3f %.3f %.4f %s' % (atmparam[0], atmparam[1], atmparam[2], atmparam[3], fout))
+    print('run_custom_interpolator in custom_conv.py has not been written yet!')
+    raise SystemExit()
@@ -1,90 +1,87 @@
 # This module contains methods related to differential analysis
-import os
 import numpy as np
-import matplotlib.pyplot as plt
-from moognmodels import run_moog, run_model
-from parsemoog import parse_moog_fe, diff_ovec
+import moogcache
+from moognmodels import evaluate, evaluate_many, clamp_params
+from runcontext import RunContext, moogpar
 from setup_converge import dif_anal_init
-from jacobian import jacobian_update
-from converge_plots import make_dif_feplot
+import solver
+import timing
+from solver import solve
+from surrogate import Surrogate, history_key
+from converge_plots import make_dif_feplot, make_iteration_plot
 
-def reference_star(finref='ref.par', finrefatm='refatm', stdout='ref.out'):
+# reference star observables already computed in this process, by hash of the input files
+global _refcache; _refcache = {}
+
+def reference_star(finref='ref.par', finrefatm='refatm', ctx=None):
     "Returns the observables from the reference star"
     "This method needs existing finref and finrefatm files to work"
     "finref: MOOG input file for reference star"
     "finrefatm: ASCII file containing the reference atmospheric parameters. Must be written as a single-line text file in the format 'Teff logg metal micro'"
-    "stdout: MOOG summary_out for reference star"
+    "ctx: RunContext of the analysis (for the scratch folder); the reference star runs in a scratch directory of its own,"
+    "with finref as MOOG input file, and the files in the current folder are not touched"
+    "The reference star is computed only once per process for the same finref, finrefatm and line list,"
+    "and MOOG is not run again for it in later processes (see moogcache.py)"
     
-    # backing-up the MOOG input file
-    os.system('cp batch.par backupforrefrun.par')
-    os.system('cp %s batch.par' % finref)
-    # runs reference star
-    refatm = np.genfromtxt(finrefatm)
-    run_model(refatm) # teff logg [M/H] ([Fe/H] here) micro
-    run_moog()
-    # restores par file
-    os.system('cp batch.par %s' % finref)
-    os.system('mv backupforrefrun.par batch.par')
-    # loads Fe data
-    fe1data, fe2data = parse_moog_fe(stdout)
-    return fe1data[:,6], fe2data[:,6], refatm[2]
+    key = (moogcache.par_digest(finref), moogcache.file_digest(finrefatm))
+    if key not in _refcache:
+        refatm = np.genfromtxt(finrefatm)
+        refctx = RunContext(finref, None if ctx == None else ctx.scratch)
+        try:
+            fe1data, fe2data = evaluate(refatm, ctx=refctx).fe() # teff logg [M/H] ([Fe/H] here) micro
+        finally:
+            refctx.cleanup()
+        _refcache[key] = (fe1data[:,6], fe2data[:,6], refatm[2])
+    return _refcache[key]
 
-def diff_main(par0, makeplot, stdout='a.out'):
+def diff_main(par0, makeplot, stdout='a.out', ctx=None, jinit=None, ref=None, method=None):
     "The main routine for differential analysis"
     "par0 (list): Initial guess of the atmospheric parameters given as command-line argument"
     "makeplot (boolean): command-line option. If true, iteration sequence is plotted"
+    "ctx (RunContext): scratch directory and output folder of the analysis (if None, the current folder is used)"
+    "jinit (string): initial Jacobian, 'cmatrix' or 'fd' (jacinit in setup_converge.py if None)"
+    "ref (tuple): observables of the reference star, as returned by reference_star (computed here if None)"
+    "method (string): solver strategy (strategy in solver.py if None)"
+    "Returns the final parameters, quadrature, Jacobian, the MoogRun at the final parameters, the number of iterations"
+    "and the solver history (MOOG calls and time of each iteration)"
     
     # loads reference star info
-    fe1ref, fe2ref, refmh = reference_star()
+    if ref == None:
+        ref = reference_star(ctx=ctx)
+    fe1ref, fe2ref, refmh = ref
+    
+    # initialisation of the solver
+    p1, Jn, ovec, pn, quadr, run = dif_anal_init(par0, fe1ref, fe2ref, refmh, ctx, jinit)
+    
+    def observe(p):
+        # external stuff: creates an input model for MOOG, runs MOOG and loads its results
+        run = evaluate(p, stdout, ctx=ctx)
+        run.ovec = np.asarray(run.diff_observables(fe1ref, fe2ref, p[2], refmh))
+        return run
+    
+    def observe_many(points):
+        runs = evaluate_many(points, ctx=ctx)
+        for p, run in zip(points, runs):
+            run.ovec = np.asarray(run.diff_observables(fe1ref, fe2ref, p[2], refmh))
+        return runs
+    
+    # surrogate of the observables, shared with earlier runs of this star with the same reference star
+    surr = None
+    if solver.usesurrogate == True:
+        surr = Surrogate(history_key(moogcache.par_digest(moogpar if ctx == None else ctx.par), 'differential', fe1ref.tobytes(), fe2ref.tobytes(), refmh))
     
-    # initialisation of Broyden's method
-    p1, Jn, ovec, pn, quadr = dif_anal_init(par0, fe1ref, fe2ref, refmh)
+    # machine-readable record of each iteration, if requested (see timing.py)
+    records = None
+    if timing.jsonl == True:
+        records = 'iterations.jsonl' if ctx == None else ctx.output('iterations.jsonl')
     
-    # === using Broyden's method to converge the atmospheric parameters ===
-    old_quadr = 6e23
-    counter = 0
+    # === converging the atmospheric parameters ===
     # creating matplotlib object if the option of plotting the iterations is requested
-    if makeplot == True:
-        fig, ax = plt.subplots(2,2)
-    while quadr > 0.001 and abs(old_quadr - quadr) > 1e-7 and counter < 20:
-        # updates the atmospheric parameters vector
-        Jinv = np.linalg.inv(Jn)
-        delta_p = -np.dot(Jinv, ovec)
-        pn = pn + delta_p
-        old_ovec = ovec
-        
-        # external stuff: creates an input model for MOOG and runs MOOG
-        run_model(pn)
-        run_moog()
-        
-        # loading results from MOOG
-        ovec = np.asarray(diff_ovec(stdout, fe1ref, fe2ref, pn[2], refmh))
-        
-        # the minimization parameter
-        old_quadr = quadr
-        quadr = np.linalg.norm(ovec)
-        
-        # this will be useful if convergence is not yet achieved
-        counter = counter + 1
-        if p1.shape[0] == 4:
-            pn_1 = pn-delta_p
-            Jn = jacobian_update(Jn, pn_1, pn, old_ovec, ovec)
-        
-        # print info about the current iteration
-        print('%7.1e %2i' % (quadr, counter))
-        print(delta_p)
-        
-        # populate the plots if requested
-        if makeplot == True:
-            ax[0,0].scatter(counter, ovec[0])
-            ax[0,1].scatter(counter, ovec[1])
-            ax[1,0].scatter(counter, ovec[2])
-            ax[1,1].scatter(counter, ovec[3])
-            ax[0,0].hlines(0.0, 0.0, counter, linestyles='dotted')
-            ax[0,1].hlines(0.0, 0.0, counter, linestyles='dotted')
-            ax[1,0].hlines(0.0, 0.0, counter, linestyles='dotted')
-            ax[1,1].hlines(0.0, 0.0, counter, linestyles='dotted')
+    callback = make_iteration_plot() if makeplot == True else None
+    pn, quadr, Jn, run, counter, history = solve(observe, pn, Jn, ovec, run, method, observe_many, callback=callback, clamp=clamp_params, surr=surr, records=records)
     
     # Creates (differential) Boltzmann plots    
-    make_dif_feplot(fe1ref, fe2ref, pn[2], refmh)
-    return pn, quadr, Jn
+    fplot = 'feplot.png' if ctx == None else ctx.output('feplot.png')
+    if fplot != None:
+        make_dif_feplot(fe1ref, fe2ref, pn[2], refmh, run, fplot)
+    return pn, quadr, Jn, run, counter, history
@@ -1,7 +1,13 @@
 # interpolator for 1D LTE models
 # Please use "kurucz_extractor.py" to download the models in the format accepted by this module
+import os
+import hashlib
+from tempfile import mkstemp
+from itertools import product
+from collections import OrderedDict
+from functools import reduce
 import numpy as np
-from scipy.interpolate import interp1d, interp2d, LinearNDInterpolator, NearestNDInterpolator
+from scipy.spatial import Delaunay
 
 # === USER OPTIONS AREA ===
 
@@ -18,81 +24,94 @@ global format_type; format_type = 'KURUCZ'
 global metalist; metalist = ['am40','am25','am20','am15','am10','am05','ap00','ap02','ap05']
 global metalval; metalval = np.array([-4.0, -2.5, -2.0, -1.5, -1.0, -0.5,  0.0,  0.2,  0.5])
 
-# === END OF USER OPTIONS AREA ===
+# if True, each grid file is converted once to a binary copy ('<file>.npz' in the same folder)
+# and the binary copy is read afterwards. The copy is rebuilt whenever the text file is newer.
+global usebinary; usebinary = True
 
-def pick_model_name(metal):
-    'Sorts models by metallicity'
-    'Returns the filenames of the two metallicity nearest neighbours in the grid.'
-    if metal in metalval:
-        fin = metalist[np.argmin(abs(metal-metalval))]
-        return fin, None
-    elif np.amin(metalval) < metal and metal < np.amax(metalval):
-        dif = metal-metalval
-        for i in range(1,dif.shape[0]):
-            if dif[i] < 0 and dif[i-1] > 0:
-                idx1 = i-1
-                idx2 = i
-                break
-        return metalist[idx1], metalist[idx2]
-    else:
-        print('Interpolator: INVALID METALLICITY! [M/H] = %.2f' % metal)
-        raise SystemExit()
+# cache of interpolated models, kept by the ModelGrid object
+# cachesize: maximum number of models kept in memory (least recently used are dropped first; 0 disables the cache)
+# cachedigits: None, or the number of decimal places Teff, logg and [M/H] are rounded to before interpolation,
+# so that points closer than this share the same model (e.g. [1, 3, 3]; negative values are allowed, -1 rounds Teff to 10 K)
+# With None only identical parameters share a model. Any rounding may change the convergence path slightly,
+# since MOOG prints abundances with only three decimals.
+global cachesize; cachesize = 128
+global cachedigits; cachedigits = None
 
-def check_teff_logg(teff, logg, t, g):
-    "Checks if Teff and logg are in the interpolation limits."
-    if teff < t.min() or teff > t.max():
-        print('Interpolator: INVALID TEFF! Teff = %4i' % teff)
-        raise SystemExit()
-    elif logg < g.min() or logg > g.max():
-        print('Interpolator: INVALID LOGG! logg = %.3f' % logg)
-        raise SystemExit()
-    else:
-        return
-
-def create_par_lists(t):
-    tefflist = []; logglist = []
-    for i in range(len(t)):
-        if 'MODEL' in t[i]:
-            tefflist.append(float(t[i+1].split()[0]))
-            logglist.append(float(t[i+1].split()[1]))
-    tefflist = np.asarray(tefflist); logglist = np.asarray(logglist)
-    return tefflist, logglist
+# === END OF USER OPTIONS AREA ===
 
-def copy_model(teff, logg, metal, fin):
-    "Just copies a model in case all four input atmospheric parameters are in the grid."
-    f = open('%s%s' % (gridpath,fin), 'r')
-    t = f.readlines()
+def parse_grid_file(fname):
+    "Reads a text grid file in the format generated by kurucz_extractor.py"
+    "Returns the Teff and logg of each model and a (model, depth, column) array with the model structures"
+    f = open(fname, 'r')
+    t = f.read().splitlines()
     f.close()
-    tefflist, logglist = create_par_lists(t)
-    check_teff_logg(teff, logg, tefflist, logglist)
-    for i in range(len(t)):
-        if 'MODEL' in t[i] and float(t[i+1].split()[0]) == teff and float(t[i+1].split()[1]) == logg:
+    tefflist = []; logglist = []; ntaulist = []; rows = []
+    i = 0
+    while i < len(t):
+        if 'MODEL' in t[i]:
             ntau = int(t[i].split()[1])
-            idx0 = i+2
-            idx1 = i+2+ntau
-            break
-    mod = t[idx0:idx1]
-    model = mod_l2a(mod, ntau, len(mod[0].split()))
-    return model
+            tg = t[i+1].split()
+            tefflist.append(float(tg[0]))
+            logglist.append(float(tg[1]))
+            ntaulist.append(ntau)
+            rows.extend(t[i+2:i+2+ntau])
+            i = i+2+ntau
+        else:
+            i = i+1
+    if len(set(ntaulist)) != 1:
+        print('Interpolator: all models in %s must have the same number of layers!' % fname)
+        raise SystemExit()
+    ncols = len(rows[0].split())
+    models = np.array(' '.join(rows).split(), dtype=float).reshape(len(ntaulist), ntaulist[0], ncols)
+    return np.asarray(tefflist), np.asarray(logglist), models
 
-def load_some_model(teff, logg, t):
-    "Returns 2D np array"
-    for i in range(len(t)):
-        if 'MODEL' in t[i] and float(t[i+1].split()[0]) == teff and float(t[i+1].split()[1]) == logg:
-            ntau = int(t[i].split()[1])
-            idx0 = i+2
-            idx1 = i+2+ntau
-            break
-    mod = t[idx0:idx1]
-    model = mod_l2a(mod, ntau, len(mod[0].split()))
-    return model
+def write_binary_grid(fname, tefflist, logglist, models):
+    "Writes the binary copy of the text grid file fname"
+    # written to a temporary file first, so that a concurrent run never reads a partial copy
+    ftmp = '%s.%i.tmp' % (fname, os.getpid())
+    try:
+        f = open(ftmp, 'wb')
+        np.savez(f, teff=tefflist, logg=logglist, models=models)
+        f.close()
+        os.replace(ftmp, '%s.npz' % fname)
+    except OSError:
+        if os.path.isfile(ftmp):
+            os.remove(ftmp)
+        raise
+
+def save_binary_grid(fname):
+    "Converts one text grid file to its binary copy"
+    tefflist, logglist, models = parse_grid_file(fname)
+    write_binary_grid(fname, tefflist, logglist, models)
+    return tefflist, logglist, models
 
-def mod_l2a(m, nlines, ncols):
-    model = np.zeros((nlines,ncols))
-    for i in range(nlines):
-        for j in range(ncols):
-            model[i,j] = float(m[i].split()[j])
-    return model
+def convert_grid(path=None):
+    "One-time conversion of all files listed in metalist to binary copies"
+    if path == None:
+        path = gridpath
+    for fin in metalist:
+        if os.path.isfile('%s%s' % (path,fin)):
+            save_binary_grid('%s%s' % (path,fin))
+
+def load_grid(fin, path=None):
+    "Returns the Teff and logg lists and the model structures of grid file fin"
+    "The binary copy is used if it is up to date, otherwise the text file is parsed (and converted if usebinary is True)"
+    if path == None:
+        path = gridpath
+    fname = '%s%s' % (path,fin)
+    fbin = '%s.npz' % fname
+    if usebinary == True and os.path.isfile(fbin):
+        if not os.path.isfile(fname) or os.path.getmtime(fbin) >= os.path.getmtime(fname):
+            with np.load(fbin) as d:
+                return d['teff'], d['logg'], d['models']
+    tefflist, logglist, models = parse_grid_file(fname)
+    if usebinary == True:
+        try:
+            write_binary_grid(fname, tefflist, logglist, models)
+        except OSError:
+            # e.g., a read-only or shared grid folder: the text file is parsed again in the next run
+            pass
+    return tefflist, logglist, models
 
 def make_footer(metal, micro):
     "Prepares model footer for MOOG input"
@@ -113,281 +132,303 @@ def make_header(teff, logg, metal, micro, ntau):
         s.append('5000.0\n')
     return s
 
-def get2models(p, l, t, p2, fp):
-    if fp == 'logg':
-        k = 0; h = 1;
-    else:
-        k = 1; h = 0
-    dif = p-l
-    for i in range(1,dif.shape[0]):
-        if dif[i] < 0 and dif[i-1] > 0:
-            idxt1 = i-1
-            idxt2 = i
-            break
-    for i in range(len(t)):
-        if 'MODEL' in t[i] and float(t[i+1].split()[k]) == l[idxt1] and float(t[i+1].split()[h]) == p2:
-            ntau = int(t[i].split()[1])
-            idx0 = i+2
-            idx1 = i+2+ntau
-            break
-    m1 = t[idx0:idx1]
-    model1 = mod_l2a(m1, ntau, len(m1[0].split()))
-    for i in range(len(t)):
-        if 'MODEL' in t[i] and float(t[i+1].split()[k]) == l[idxt2] and float(t[i+1].split()[h]) == p2:
-            ntau = int(t[i].split()[1])
-            idx0 = i+2
-            idx1 = i+2+ntau
-            break
-    m2 = t[idx0:idx1]
-    model2 = mod_l2a(m2, ntau, len(m2[0].split()))
-    return model1, model2, l[idxt1], l[idxt2]
-
-def get4models(teff, logg, metal, mod1, mod2, fp):
-    # 2----4
-    # |  0 |
-    # 1----3
-    if fp != 'm':
-        dif = metal-metalval
-        for i in range(1,dif.shape[0]):
-            if dif[i] < 0 and dif[i-1] > 0:
-                idx1 = i-1
-                idx2 = i
-                break
-        y1 = metalval[idx1]; y2 = metalval[idx2]
-        y3 = metalval[idx1]; y4 = metalval[idx2]
-    if fp == 'teff':
-        f = open('%s%s' % (gridpath,mod1), 'r'); t = f.readlines(); f.close()
-        tefflist, logglist = create_par_lists(t); check_teff_logg(teff, logg, tefflist, logglist)
-        m1, m3, x1, x3 = get2models(logg, logglist, t, teff, fp)
-        f = open('%s%s' % (gridpath,mod2), 'r'); t = f.readlines(); f.close()
-        tefflist, logglist = create_par_lists(t); check_teff_logg(teff, logg, tefflist, logglist)
-        m2, m4, x2, x4 = get2models(logg, logglist, t, teff, fp)
-    elif fp == 'logg':
-        f = open('%s%s' % (gridpath,mod1), 'r'); t = f.readlines(); f.close()
-        tefflist, logglist = create_par_lists(t); check_teff_logg(teff, logg, tefflist, logglist)
-        m1, m3, x1, x3 = get2models(teff, tefflist, t, logg, fp)
-        f = open('%s%s' % (gridpath,mod2), 'r'); t = f.readlines(); f.close()
-        tefflist, logglist = create_par_lists(t); check_teff_logg(teff, logg, tefflist, logglist)
-        m2, m4, x2, x4 = get2models(teff, tefflist, t, logg, fp)
-    else:
-        f = open('%s%s' % (gridpath,mod1), 'r'); t = f.readlines(); f.close()
-        tefflist, logglist = create_par_lists(t); check_teff_logg(teff, logg, tefflist, logglist)
-        dift = teff - tefflist; difg = logg - logglist
-        for i in range(1,dift.shape[0]):
-            if dift[i] < 0 and dift[i-1] > 0:
-                idx1 = i-1
-                idx2 = i
-                break
-        for i in range(1,difg.shape[0]):
-            if difg[i] < 0 and difg[i-1] > 0:
-                idy1 = i-1
-                idy2 = i
-                break
-        x1 = tefflist[idx1]; x2 = tefflist[idx1]; x3 = tefflist[idx2]; x4 = tefflist[idx2]
-        y1 = logglist[idy1]; y2 = logglist[idy2]; y3 = logglist[idy1]; y4 = logglist[idy2]
-        ml = []
-        xl = [x1, x2, x3, x4]; yl = [y1,y2,y3,y4]
-        for i in range(4):
-            ml.append(copy_model(xl[i], yl[i], metal, mod1))
-        m1 = ml[0]; m2 = ml[1]; m3 = ml[2]; m4 = ml[3]
-    x = np.array([x1,x2,x3,x4])
-    y = np.array([y1,y2,y3,y4])
-    m = [m1,m2,m3,m4]
-    return x, y, m
+def linear_weights(x0, x1, x2):
+    "Weights of the two bracketing nodes x1 < x0 < x2 in a linear interpolation"
+    u = (x0-x1)/(x2-x1)
+    return np.array([1.-u, u])
 
-def i1d(teff, logg, metal, mod1, mod2):
-    # 1d linear interpolation
-    f = open('%s%s' % (gridpath,mod1), 'r')
-    t = f.readlines()
-    f.close()
-    tefflist, logglist = create_par_lists(t)
-    check_teff_logg(teff, logg, tefflist, logglist)
-    if teff not in tefflist:
-        # interpolate in teff
-        x0 = teff
-        m1, m2, x1, x2 = get2models(teff, tefflist, t, logg, 'logg')
-    elif logg not in logglist:
-        # interpolate in logg
-        x0 = logg
-        m1, m2, x1, x2 = get2models(logg, logglist, t, teff, 'teff')
+def simplex_weights(points, p0, whichinterp='linear'):
+    "Weights of the nodes in 'points' for the point p0"
+    "'linear' gives the same result as scipy's LinearNDInterpolator(points, values, rescale=True),"
+    "i.e., linear interpolation inside the Delaunay simplex containing p0; 'nearest' picks the nearest node"
+    offset = np.mean(points, axis=0)
+    scale = np.ptp(points, axis=0)
+    sp = (points-offset)/scale
+    sp0 = (np.asarray(p0, dtype=float)-offset)/scale
+    w = np.zeros(points.shape[0])
+    if whichinterp == 'linear':
+        tri = Delaunay(sp)
+        s = tri.find_simplex(sp0)
+        b = np.dot(tri.transform[s,:-1], sp0-tri.transform[s,-1])
+        w[tri.simplices[s]] = np.append(b, 1.-np.sum(b))
     else:
-        # interpolate in metal
-        x0 = metal
-        dif = metal-metalval
-        for i in range(1,dif.shape[0]):
-            if dif[i] < 0 and dif[i-1] > 0:
-                idx1 = i-1
-                idx2 = i
-                break
-        x1 = metalval[idx1]; x2 = metalval[idx2]
-        m1 = copy_model(teff, logg, metal, mod1)
-        m2 = copy_model(teff, logg, metal, mod2)
-    im = np.zeros(m1.shape) # m2.shape supposed to be the same
-    x = np.array([x1,x2])
-    for i in range(im.shape[1]):
-        y = np.array([m1[:,i],m2[:,i]])
-        z = interp1d(x, y, axis=0)
-        im[:,i] = z(x0)
-    return im
+        w[np.argmin(np.sum((sp-sp0)**2, axis=1))] = 1.
+    return w
 
-def i2d(teff, logg, metal, mod1, mod2, trueidx):
-    # 2d linear interpolation
-    if trueidx == 0:
-        # teff in grid
-        x, y, m = get4models(teff, logg, metal, mod1, mod2, 'teff')
-        x0 = logg; y0 = metal
-    elif trueidx == 1:
-        # logg in grid
-        x, y, m = get4models(teff, logg, metal, mod1, mod2, 'logg')
-        x0 = teff; y0 = metal
-    else:
-        # metal in grid
-        x, y, m = get4models(teff, logg, metal, mod1, mod2, 'm')
-        x0 = teff; y0 = logg
-    im = np.zeros(m[0].shape)
-    for i in range(im.shape[1]): # i -> model column
-        for k in range(im.shape[0]): # k -> model line
-            z = np.zeros(4)
-            for j in range(4): # j -> m list id (m1, m2, m3 or m4 from get4models)
-                z[j] = m[j][k,i]
-            i2 = interp2d(x, y, z)
-            im[k,i] = i2(x0, y0)
-    return im
+def interp_models(m, w):
+    "Weighted sum of the node models m with weights w, computed for all depths and columns at once"
+    return np.tensordot(w, np.asarray(m), axes=1)
 
-def i3d(teff, logg, metal, mod1, mod2):
-    # 3d interpolation
-    # xi -> teff; yi -> logg; zi -> metal
-    whichinterp = 'linear' # nearest or linear -- linear seems to give better results
-    f = open('%s%s' % (gridpath,mod1), 'r'); t1 = f.readlines(); f.close()
-    tefflist, logglist = create_par_lists(t1); check_teff_logg(teff, logg, tefflist, logglist)
-    x = find_param(teff, tefflist)
-    y = find_param(logg, logglist)
-    z = find_metal(metal)
-    f = open('%s%s' % (gridpath,mod2), 'r'); t2 = f.readlines(); f.close()
-    # I am assuming x and y will be the same here
-    t = [t1,t2]
-    m = []
-    #x8 = []; y8 = []; z8 = []
-    points = np.zeros((8,3))
-    l = 0
-    for i in range(len(x)):
-        for j in range(len(y)):
-            for k in range(len(t)):
-                points[l,:] = [x[i], y[j], z[k]]; l=l+1
-                m.append(load_some_model(x[i],y[j],t[k]))
-    # LinearNDInterpolator
-    model = np.zeros(m[0].shape)
-    for i in range(model.shape[0]):
-        for j in range(model.shape[1]):
-            values = np.zeros(8)
-            for k in range(8):
-                values[k] = m[k][i,j]
-            if whichinterp == 'linear':
-                i3 = LinearNDInterpolator(points, values, rescale=True)
+class ModelGrid:
+    "The whole model grid, loaded once and kept in memory"
+    "Grid axes are sorted arrays, models are found through a (teff, logg, metal) index,"
+    "and the Teff/logg limits of each metallicity are computed only once"
+    
+    def __init__(self, path=None, whichinterp='linear', maxcache=None, digits=None):
+        if path == None:
+            path = gridpath
+        if maxcache == None:
+            maxcache = cachesize
+        if digits == None:
+            digits = cachedigits
+        self.path = path
+        self.whichinterp = whichinterp # nearest or linear (3d case only) -- linear seems to give better results
+        self.maxcache = maxcache
+        self.digits = digits
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        order = np.argsort(metalval)
+        self.metal = np.asarray(metalval, dtype=float)[order]
+        self.files = [metalist[k] for k in order]
+        self.index = {}
+        self.models = []
+        tlim = []; glim = []; teff = []; logg = []
+        for k in range(len(self.files)):
+            if not os.path.isfile('%s%s' % (path,self.files[k])) and not os.path.isfile('%s%s.npz' % (path,self.files[k])):
+                print('Interpolator: grid file %s%s not found!' % (path,self.files[k]))
+                raise SystemExit()
+            tefflist, logglist, models = load_grid(self.files[k], path)
+            self.models.append(models)
+            for i in range(tefflist.shape[0]):
+                self.index[(tefflist[i], logglist[i], self.metal[k])] = (k, i)
+            tlim.append([tefflist.min(), tefflist.max()])
+            glim.append([logglist.min(), logglist.max()])
+            teff.append(tefflist); logg.append(logglist)
+        self.teff = np.unique(np.concatenate(teff))
+        self.logg = np.unique(np.concatenate(logg))
+        self.tlim = np.array(tlim)
+        self.glim = np.array(glim)
+        self._digest = None
+    
+    def digest(self):
+        "sha256 of the contents of the grid (part of the key of the MOOG cache), computed on first use"
+        if self._digest == None:
+            h = hashlib.sha256()
+            h.update(self.metal.tobytes())
+            for k in sorted(self.index):
+                h.update(np.array(k + self.index[k], dtype=float).tobytes())
+            for m in self.models:
+                h.update(np.ascontiguousarray(m).tobytes())
+            self._digest = h.hexdigest()
+        return self._digest
+    
+    def bracket(self, x, axis):
+        "Indices of the grid nodes around x in a sorted axis; the second index is None if x is a node"
+        i = np.searchsorted(axis, x)
+        if i < axis.shape[0] and axis[i] == x:
+            return i, None
+        return i-1, i
+    
+    def limits(self, metal):
+        "Valid Teff and logg intervals for the given metallicity"
+        "Returns [tmin, tmax], [gmin, gmax]"
+        k1, k2 = self.bracket(metal, self.metal)
+        if k2 == None:
+            k2 = k1
+        tl = [max(self.tlim[k1,0], self.tlim[k2,0]), min(self.tlim[k1,1], self.tlim[k2,1])]
+        gl = [max(self.glim[k1,0], self.glim[k2,0]), min(self.glim[k1,1], self.glim[k2,1])]
+        return tl, gl
+    
+    def check(self, teff, logg, metal):
+        "Checks if the atmospheric parameters are in the interpolation limits."
+        if metal < self.metal[0] or metal > self.metal[-1]:
+            print('Interpolator: INVALID METALLICITY! [M/H] = %.2f' % metal)
+            raise SystemExit()
+        tl, gl = self.limits(metal)
+        if teff < tl[0] or teff > tl[1]:
+            print('Interpolator: INVALID TEFF! Teff = %4i' % teff)
+            raise SystemExit()
+        elif logg < gl[0] or logg > gl[1]:
+            print('Interpolator: INVALID LOGG! logg = %.3f' % logg)
+            raise SystemExit()
+        else:
+            return
+    
+    def clamp(self, teff, logg, metal):
+        "Nearest atmospheric parameters inside the interpolation limits"
+        "Returns teff, logg, metal"
+        metal = min(max(metal, self.metal[0]), self.metal[-1])
+        tl, gl = self.limits(metal)
+        return min(max(teff, tl[0]), tl[1]), min(max(logg, gl[0]), gl[1]), metal
+    
+    def node(self, teff, logg, metal):
+        "Returns the model of a grid node as a 2D np array (depth, column)"
+        try:
+            k, i = self.index[(teff, logg, metal)]
+        except KeyError:
+            print('Interpolator: model Teff = %4i logg = %.2f [M/H] = %.2f is missing in the grid!' % (teff, logg, metal))
+            raise SystemExit()
+        return self.models[k][i]
+    
+    def key(self, teff, logg, metal):
+        "Parameters rounded as in the model cache (unchanged if the cache is disabled or digits is None)"
+        if self.maxcache > 0 and self.digits != None:
+            return (round(float(teff), self.digits[0]), round(float(logg), self.digits[1]), round(float(metal), self.digits[2]))
+        else:
+            return (float(teff), float(logg), float(metal))
+    
+    def create_model(self, teff, logg, metal):
+        "Returns the model structure (w/o header and footer) at the given Teff, logg and metallicity"
+        "Parameters are rounded to self.digits decimal places (if set), and models already interpolated are taken from the cache"
+        key = self.key(teff, logg, metal)
+        if self.maxcache > 0:
+            if key in self.cache:
+                self.hits = self.hits + 1
+                self.cache.move_to_end(key)
+                return self.cache[key].copy()
+            self.misses = self.misses + 1
+            model = self.interpolate(*key)
+            self.cache[key] = model
+            if len(self.cache) > self.maxcache:
+                self.cache.popitem(last=False)
+            return model.copy()
+        else:
+            return self.interpolate(*key)
+    
+    def create_models(self, params):
+        "Batch version of create_model: params is an (N, 3) or (N, 4) array of Teff, logg, [M/H] (and micro)"
+        "Returns an (N, ntau, ncols) array. Each grid node is read once and all models are computed in one pass"
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        nodes = {}; idx = []; wl = []
+        for p in params:
+            corners, w = self.weights(*self.key(p[0], p[1], p[2]))
+            idx.append([nodes.setdefault(c, len(nodes)) for c in corners])
+            wl.append(w)
+        W = np.zeros((params.shape[0], len(nodes)))
+        for n in range(params.shape[0]):
+            W[n,idx[n]] = wl[n]
+        m = [self.node(*c) for c in nodes]
+        return interp_models(m, W)
+    
+    def cache_info(self):
+        "Hit/miss counters and size of the model cache"
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache), 'maxsize': self.maxcache}
+    
+    def clear_cache(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+    
+    def weights(self, teff, logg, metal):
+        "Grid nodes used to interpolate the model at the given Teff, logg and metallicity, and their weights"
+        "One node if all parameters are grid nodes, otherwise linear interpolation in 1d, bilinear in 2d,"
+        "and linear inside the Delaunay simplex in 3d"
+        self.check(teff, logg, metal)
+        p0 = [teff, logg, metal]
+        nodes = []; wlist = []
+        for x, axis in zip(p0, [self.teff, self.logg, self.metal]):
+            i1, i2 = self.bracket(x, axis)
+            if i2 == None:
+                nodes.append([axis[i1]])
+                wlist.append(np.ones(1))
             else:
-                i3 = NearestNDInterpolator(points, values, rescale=True)
-            model[i,j] = i3(teff, logg, metal)
-    return model
+                nodes.append([axis[i1], axis[i2]])
+                wlist.append(linear_weights(x, axis[i1], axis[i2]))
+        corners = list(product(*nodes))
+        if len(corners) == 8:
+            # full 3d interpolation
+            w = simplex_weights(np.array(corners), p0, self.whichinterp)
+        else:
+            # model in the grid, 1d or 2d interpolation
+            w = reduce(np.multiply.outer, wlist).ravel()
+        return corners, w
+    
+    def interpolate(self, teff, logg, metal):
+        "Interpolates the model structure (w/o header and footer) at the given Teff, logg and metallicity"
+        corners, w = self.weights(teff, logg, metal)
+        m = [self.node(*c) for c in corners]
+        if len(corners) == 1:
+            # model is in the grid...just copy it
+            return m[0].copy()
+        return interp_models(m, w)
 
-def find_metal(metal):
-    dif = metal-metalval
-    for i in range(1,dif.shape[0]):
-        if dif[i] < 0 and dif[i-1] > 0:
-            idx1 = i-1
-            idx2 = i
-            break
-    y1 = metalval[idx1]; y2 = metalval[idx2]
-    return y1, y2
+global _grid; _grid = None
 
-def find_param(par, parlist):
-    dif = par-parlist
-    for i in range(1,dif.shape[0]):
-        if dif[i] < 0 and dif[i-1] > 0:
-            idx1 = i-1
-            idx2 = i
-            break
-    x1 = parlist[idx1]; x2 = parlist[idx2]
-    return x1, x2
+def get_grid():
+    "Returns the model grid of this process, loading it on first use"
+    global _grid
+    if _grid == None:
+        _grid = ModelGrid()
+    return _grid
 
-def create_model(teff, logg, metal, micro):
+def create_model(teff, logg, metal, micro, grid=None):
     # creates and exports model w/o header and footer
     # useful for being used by modules that do not require an ascii file model
-    tstep = 250.; gstep = 0.5
-    mod1, mod2 = pick_model_name(metal)
-    check = np.array([teff % tstep == 0, logg % gstep == 0, mod2==None])
-    nfalse = np.size(check) - np.count_nonzero(check)
-    if check.all() == True:
-        # model is in the grid...just copy it
-        model = copy_model(teff, logg, metal, mod1)
-    elif nfalse == 1:
-        # 1d interpolation -- 2 points in the grid
-        model = i1d(teff, logg, metal, mod1, mod2)
-    elif nfalse == 2:
-        # 2d interpolation -- 1 point in the grid
-        for i in range(check.shape[0]):
-            if check[i] == True:
-                trueidx = i
-                break
-        model = i2d(teff, logg, metal, mod1, mod2, trueidx)
+    # grid is a ModelGrid; if None, the grid kept by this process is used
+    if grid == None:
+        grid = get_grid()
+    return grid.create_model(teff, logg, metal)
+
+def create_models(params, grid=None):
+    # creates many models at once w/o header and footer
+    # params is an (N, 4) array, one row [Teff, logg, metal, micro] per model; returns an (N, ntau, ncols) array
+    if grid == None:
+        grid = get_grid()
+    return grid.create_models(params)
+
+def model_rows(model):
+    "Formats the depth rows of the MOOG model file as a single string, in one formatting call for the whole table"
+    if format_type == 'KURTYPE':
+        rowfmt = '%15.8E%9.1f%10.3E%10.3E\n'; ncols = 4
+    elif format_type == 'KURUCZ':
+        rowfmt = '%15.8E%9.1f%10.3E%10.3E%10.3E%10.3E%10.3E\n'; ncols = 7
     else:
-        # full 3d interpolation
-        model = i3d(teff, logg, metal, mod1, mod2)
-    return model
+        print('Invalid model type!')
+        raise SystemExit()
+    return (rowfmt*model.shape[0]) % tuple(model[:,:ncols].ravel())
 
-def run_interpolator(atmpar, tstep=250., gstep=0.5):
-    "Manages model interpolation from the input atmospheric parameters and saves it to a text file"
+# Teff, logg, [M/H] and formatted depth rows of the last model created by model_file
+# microturbulence only enters the header and footer, so the rows are reused while the other parameters do not change
+global _lastrows; _lastrows = None
+
+def model_file(atmpar, grid=None):
+    "Returns the complete MOOG model file (header, depth rows and footer) as bytes; nothing is written to disc"
     "atmpar is a list or numpy array with the input atmospheric parameters [Teff, logg, metal, micro]"
-    "tstep is the delta Teff in K in model grid"
-    "gstep is the delta logg in dex in model grid"
+    "grid is a ModelGrid instance; if None, the grid is loaded on the first call and kept in memory"
+    global _lastrows
     teff = atmpar[0]
     logg = atmpar[1]
     metal = atmpar[2]
     micro = atmpar[3]
-    mod1, mod2 = pick_model_name(metal)
-    # the following line only works if minimum Teff in grid % tstep = 0 and minimum logg in grid % gstep = 0
-    # For instance, it works with default tstep value (250) if the lower Teff value in the grid is 1000 or 3500, but fails if the value is, e.g., 4248
-    # If you really need such unorthodox configuration, add some offset value so that min grid Teff % tstep = 0 and/or min grid logg % gstep = 0
-    check = np.array([teff % tstep == 0, logg % gstep == 0, mod2==None])
-    nfalse = np.size(check) - np.count_nonzero(check)
-    if check.all() == True:
-        # model is in the grid...just copy it
-        model = copy_model(teff, logg, metal, mod1)
-    elif nfalse == 1:
-        # 1d interpolation -- 2 points in the grid
-        model = i1d(teff, logg, metal, mod1, mod2)
-    elif nfalse == 2:
-        # 2d interpolation -- 1 point in the grid
-        for i in range(check.shape[0]):
-            if check[i] == True:
-                trueidx = i
-                break
-        model = i2d(teff, logg, metal, mod1, mod2, trueidx)
+    key = (teff, logg, metal, format_type, grid)
+    if _lastrows != None and _lastrows[0] == key:
+        # only microturbulence changed: header and footer are rewritten, depth rows are reused
+        rows, ntau = _lastrows[1], _lastrows[2]
     else:
-        # full 3d interpolation
-        model = i3d(teff, logg, metal, mod1, mod2)
-    strh = make_header(teff, logg, metal, micro, model.shape[0])
+        model = create_model(teff, logg, metal, micro, grid)
+        rows, ntau = model_rows(model), model.shape[0]
+        _lastrows = (key, rows, ntau)
+    strh = make_header(teff, logg, metal, micro, ntau)
     strf = make_footer(metal, micro)
-    f = open('MODEL', 'w')
-    for i in range(len(strh)):
-        f.write('%s' % strh[i])
-    for i in range(model.shape[0]):
-        if format_type == 'KURTYPE':
-            f.write('%15.8E%9.1f%10.3E%10.3E\n' % (model[i,0],model[i,1],model[i,2],model[i,3]))
-        elif format_type == 'KURUCZ':
-            f.write('%15.8E%9.1f%10.3E%10.3E%10.3E%10.3E%10.3E\n' % (model[i,0],model[i,1],model[i,2],model[i,3],model[i,4],model[i,5],model[i,6]))
-        else:
-            print('Invalid model type!')
-            raise SystemExit()
-    for i in range(len(strf)):
-        f.write('%s' % strf[i])
+    return ('%s%s%s' % (''.join(strh), rows, ''.join(strf))).encode()
+
+def write_model(text, fout='MODEL'):
+    "Writes a model file atomically: the text goes to a temporary file in the same folder, which is then renamed to fout"
+    "A reader of fout (e.g., MOOG) never sees a partially written model"
+    fd, ftmp = mkstemp(dir=os.path.dirname(os.path.abspath(fout)), prefix='.%s.' % os.path.basename(fout))
+    f = os.fdopen(fd, 'wb')
+    f.write(text)
     f.close()
+    os.chmod(ftmp, 0o644)
+    os.replace(ftmp, fout)
+
+def run_interpolator(atmpar, grid=None, fout='MODEL'):
+    "Manages model interpolation from the input atmospheric parameters and saves it to a text file"
+    "atmpar is a list or numpy array with the input atmospheric parameters [Teff, logg, metal, micro]"
+    "grid is a ModelGrid instance; if None, the grid is loaded on the first call and kept in memory"
+    "fout is the model file, which must coincide with model_in in the MOOG input file"
+    write_model(model_file(atmpar, grid), fout)
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser()
-    parser.add_argument('atmparam', help='Atmospheric parameters: Teff logg [M/H] micro', nargs='+', type=float)
+    parser.add_argument('atmparam', help='Atmospheric parameters: Teff logg [M/H] micro', nargs='*', type=float)
+    parser.add_argument('-c', '--convert', action='store_true', help='Converts the grid files in gridpath to binary copies and exits.')
     args = parser.parse_args()
-    if len(args.atmparam) == 4:
+    if args.convert == True:
+        convert_grid()
+    elif len(args.atmparam) == 4:
         run_interpolator(args.atmparam)
     else:
         print('Wrong number of parameters!')
\ No newline at end of file
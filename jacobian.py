@@ -1,6 +1,27 @@
 # This module has some Jacobian-related methods
+import os
+import glob
+from tempfile import mkstemp
 import numpy as np
 
+# === USER OPTIONS AREA ===
+
+# folder of the library of converged Jacobians (None disables it)
+# the Jacobian of each converged star is saved there, and jacinit = 'library' in setup_converge.py starts new stars from it
+global jacdir; jacdir = os.path.join(os.path.expanduser('~'), '.cache', 'xiru', 'jacobians')
+
+# scales of Teff, logg and [M/H] in the distance between two stars
+global jacscale; jacscale = [250., 0.25, 0.1]
+
+# number of nearest stored Jacobians averaged (with inverse-distance weights), and largest distance of a stored Jacobian that is used
+global jacnear; jacnear = 4
+global jacmaxdist; jacmaxdist = 4.
+
+# === END OF USER OPTIONS AREA ===
+
+# Jacobians of the library already read in this process, by file name
+global _library; _library = {}
+
 def jacobian_update(J0, x0, x1, ovec0, ovec1):
     "updates the Jacobian using Broyden's method"
     deltao = ovec1-ovec0
@@ -9,13 +30,74 @@ def jacobian_update(J0, x0, x1, ovec0, ovec1):
     J1 = J0 + deltaJ
     return J1
 
-def export_jac(J):
+def export_jac(J, fout='Jacobian'):
     "Exports the jacobian to a text file"
     N = J.shape[0]; M = J.shape[1]
-    f = open('Jacobian', 'w')
+    f = open(fout, 'w')
     for i in range(N):
         for j in range(M):
             f.write('%13.6e ' % J[i,j])
         f.write('\n')
     f.close()
-    return
\ No newline at end of file
+    return
+
+def store_jacobian(p, J, kind='standard'):
+    "Saves the converged Jacobian J of a star with atmospheric parameters p to the library"
+    "kind: standard, alpha or differential (the observables, and therefore the Jacobians, of each kind differ)"
+    if jacdir == None:
+        return
+    folder = os.path.join(jacdir, kind)
+    tmp = None
+    try:
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write('%.1f %.3f %.3f\n' % (p[0], p[1], p[2]))
+            for i in range(J.shape[0]):
+                for j in range(J.shape[1]):
+                    f.write('%13.6e ' % J[i,j])
+                f.write('\n')
+        # a rerun of the same star replaces its entry
+        os.replace(tmp, os.path.join(folder, '%.0f_%.2f_%.2f.jac' % (p[0], p[1], p[2])))
+    except OSError:
+        # e.g., a read-only or full home folder: the results of the star are not affected
+        if tmp != None and os.path.isfile(tmp):
+            os.remove(tmp)
+
+def read_library(kind='standard'):
+    "Returns the atmospheric parameters (N x 3) and the Jacobians (N x 4 x 4) in the library"
+    files = sorted(glob.glob(os.path.join(jacdir, kind, '*.jac'))) if jacdir != None else []
+    params = []; jacs = []
+    for fname in files:
+        try:
+            st = os.stat(fname)
+            k = (st.st_mtime_ns, st.st_size)
+            if fname not in _library or _library[fname][0] != k:
+                f = open(fname, 'r')
+                t = f.read().split()
+                f.close()
+            else:
+                t = None
+        except OSError:
+            # removed by another process in the meantime
+            continue
+        if t != None:
+            _library[fname] = (k, np.array(t[:3], dtype=float), np.array(t[3:19], dtype=float).reshape(4,4))
+        params.append(_library[fname][1]); jacs.append(_library[fname][2])
+    return np.array(params).reshape(-1,3), np.array(jacs).reshape(-1,4,4)
+
+def nearest_jacobian(p, kind='standard'):
+    "Jacobian for a star with atmospheric parameters p: inverse-distance weighted mean of the jacnear nearest ones in the library"
+    "Returns None if there is no stored Jacobian within jacmaxdist"
+    params, jacs = read_library(kind)
+    if params.shape[0] == 0:
+        return None
+    d = np.sqrt(((params - np.asarray(p[:3], dtype=float))**2/np.array(jacscale)**2).sum(axis=1))
+    near = np.argsort(d)[:jacnear]
+    near = near[d[near] <= jacmaxdist]
+    if near.shape[0] == 0:
+        return None
+    if d[near[0]] < 1e-6:
+        return jacs[near[0]].copy()
+    w = 1./d[near]**2
+    return np.tensordot(w/w.sum(), jacs[near], axes=1)
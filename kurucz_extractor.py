@@ -4,6 +4,7 @@ from urllib.request import urlopen
 from pathlib import Path
 from os import mkdir
 import numpy as np
+from interpolator import convert_grid
 
 def get_params(metal, alpha=0.0, vturb=2.0):
     "metal: string following the syntax from kurucz/castelli websites, e.g., p05 for +0.5, m15 for -1.5"
@@ -121,3 +122,6 @@ if __name__ == "__main__":
     check_dir()
     
     extractor(metal, vturb, alpha)
+    
+    # binary copies of the grid files, read by the interpolator instead of the text files
+    convert_grid('./models/')
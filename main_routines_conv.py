@@ -1,64 +1,55 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from parsemoog import parse_moog_out, parse_moog_fe
-from moognmodels import run_moog, run_model
-from jacobian import jacobian_update, export_jac
+from parsemoog import MoogRun, parse_moog_out
+from moognmodels import evaluate, evaluate_many, clamp_params
+from jacobian import export_jac, store_jacobian
+import solver
+import timing
+import moogcache
+from solver import solve
+from surrogate import Surrogate, history_key
+from runcontext import moogpar
+from converge_plots import make_iteration_plot
 
-def converge_main(p1, Jn, ovec, pn, quadr, makeplot, argsalpha):
-    "Uses Broyden's method to converge the atmospheric parameters"
+def converge_main(p1, Jn, ovec, pn, quadr, makeplot, argsalpha, run=None, ctx=None, method=None):
+    "Converges the atmospheric parameters (standard analysis) with the solver in solver.py"
+    "run is the MoogRun at pn (from std_anal_init)"
+    "ctx is the RunContext of the analysis (if None, MOOG files are in the current folder)"
+    "method: solver strategy (strategy in solver.py if None)"
+    "Returns the final parameters, quadrature, Jacobian, the MoogRun at the final parameters, the number of iterations"
+    "and the solver history (MOOG calls and time of each iteration)"
     
-    old_quadr = 6e23
-    counter = 0
-    # creating matplotlib object if requested
-    if makeplot == True:
-        fig, ax = plt.subplots(2,2)
-    while quadr > 0.001 and abs(old_quadr - quadr) > 1e-7 and counter < 20:
-        # updates the atmospheric parameters vector
-        Jinv = np.linalg.inv(Jn)
-        delta_p = -np.dot(Jinv, ovec)
-        old_ovec = ovec
-        pn = pn + delta_p
-        
-        # external stuff: creates an input model for MOOG and runs MOOG
-        run_model(pn)
-        run_moog()
-        
-        # loading results from MOOG
-        ovec = parse_moog_out(pn[2], alpha=argsalpha)
-        ovec = np.asarray(ovec)
-        old_quadr = quadr
-        
-        # the minimization parameter
-        quadr = np.linalg.norm(ovec)
-        
-        # this will be useful if convergence is not yet achieved
-        counter = counter + 1
-        if p1.shape[0] == 4:
-            pn_1 = pn-delta_p
-            Jn = jacobian_update(Jn, pn_1, pn, old_ovec, ovec)
-        
-        # print info about the current iteration
-        print('%7.1e %2i' % (quadr, counter))
-        print(delta_p)
-        
-        # populate the plots if requested
-        if makeplot == True:
-            ax[0,0].scatter(counter, ovec[0])
-            ax[0,1].scatter(counter, ovec[1])
-            ax[1,0].scatter(counter, ovec[2])
-            ax[1,1].scatter(counter, ovec[3])
-            ax[0,0].hlines(0.0, 0.0, counter, linestyles='dotted')
-            ax[0,1].hlines(0.0, 0.0, counter, linestyles='dotted')
-            ax[1,0].hlines(0.0, 0.0, counter, linestyles='dotted')
-            ax[1,1].hlines(0.0, 0.0, counter, linestyles='dotted')
-    return pn, quadr, Jn
-
-def final_remarks(pn, quadr, Jn, makeplot, argsalpha, analtype, datm):
-    "The results..."
+    def observe(p):
+        # external stuff: creates an input model for MOOG, runs MOOG and loads its results
+        run = evaluate(p, ctx=ctx)
+        run.ovec = np.asarray(run.observables(p[2], alpha=argsalpha))
+        return run
     
-    final_ovec = parse_moog_out(pn[2], alpha=argsalpha, final=True)
+    def observe_many(points):
+        runs = evaluate_many(points, ctx=ctx)
+        for p, run in zip(points, runs):
+            run.ovec = np.asarray(run.observables(p[2], alpha=argsalpha))
+        return runs
     
-    # print print print...
+    # surrogate of the observables, shared with earlier runs of this star
+    surr = None
+    if solver.usesurrogate == True:
+        surr = Surrogate(history_key(moogcache.par_digest(moogpar if ctx == None else ctx.par), 'alpha' if argsalpha == True else 'standard'))
+    
+    # machine-readable record of each iteration, if requested (see timing.py)
+    records = None
+    if timing.jsonl == True:
+        records = 'iterations.jsonl' if ctx == None else ctx.output('iterations.jsonl')
+    
+    # creating matplotlib object if requested
+    callback = make_iteration_plot() if makeplot == True else None
+    pn, quadr, Jn, run, counter, history = solve(observe, pn, Jn, ovec, run, method, observe_many, callback=callback, clamp=clamp_params, surr=surr, records=records)
+    if run == None:
+        run = MoogRun('a.out' if ctx == None else ctx.summary, pn)
+    return pn, quadr, Jn, run, counter, history
+
+def print_results(pn, quadr, final_ovec, argsalpha, analtype, datm):
+    "Prints the final results"
     print('\nFINAL RESULTS:')
     if analtype == True:
         print('Method: differential')
@@ -71,9 +62,15 @@ def final_remarks(pn, quadr, Jn, makeplot, argsalpha, analtype, datm):
     print('-- alpha: %s' % str(argsalpha))
     if argsalpha == True:
         print('-- [alpha/Fe] = %.3f\t[Fe/H] = %.3f' % (final_ovec[4], final_ovec[5]))
+
+def save_results(pn, Jn, final_ovec, argsalpha, datm, ctx=None):
+    "Saves the atmospheric parameters (atmparam), their uncertainties (unc_atmparam) and the final Jacobian (Jacobian)"
+    "ctx is the RunContext of the analysis; files are saved to its output folder (current folder if None; nothing if it saves no results)"
+    if ctx != None and ctx.save == False:
+        return
     
     # saving the atmospheric parameters to a text file
-    f = open('atmparam', 'w')
+    f = open('atmparam' if ctx == None else ctx.output('atmparam'), 'w')
     f.write('%4.1f %.3f %.3f %.4f ' % (pn[0],pn[1],pn[2],pn[3]))
     if argsalpha == True:
         f.write('%.3f %.3f\n' % (final_ovec[4], final_ovec[5]))
@@ -82,14 +79,32 @@ def final_remarks(pn, quadr, Jn, makeplot, argsalpha, analtype, datm):
     f.close()
     
     # saving the final Jacobian to a text file
-    export_jac(Jn)
+    export_jac(Jn, 'Jacobian' if ctx == None else ctx.output('Jacobian'))
     
     # saving the uncertainties of the atmospheric parameters
-    f = open('unc_atmparam', 'w')
+    f = open('unc_atmparam' if ctx == None else ctx.output('unc_atmparam'), 'w')
     f.write('%4.1f %.3f %.3f %.4f ' % (datm[0],datm[1],datm[2],datm[3]))
     f.write('\n')
     f.close()
+
+def final_remarks(pn, quadr, Jn, makeplot, argsalpha, analtype, datm, run='a.out', ctx=None):
+    "The results..."
+    "run is the MoogRun at the final parameters (or the summary_out file name)"
+    "ctx is the RunContext of the analysis; results are saved to its output folder (current folder if None)"
+    "Returns the final observables (with [alpha/Fe] and [Fe/H] if argsalpha)"
+    
+    final_ovec = parse_moog_out(pn[2], alpha=argsalpha, final=True, fin=run)
+    
+    # print print print...
+    print_results(pn, quadr, final_ovec, argsalpha, analtype, datm)
+    save_results(pn, Jn, final_ovec, argsalpha, datm, ctx)
+    
+    # saving the final Jacobian to the library, for stars with similar parameters (only if the parameters converged,
+    # and only if the results are saved, so that solve_star without outdir writes no file)
+    if quadr <= solver.tolquadr and (ctx == None or ctx.save == True):
+        store_jacobian(pn, Jn, 'differential' if analtype == True else ('alpha' if argsalpha == True else 'standard'))
     
     # if plotting is requested
     if makeplot == True:
-        plt.show()
\ No newline at end of file
+        plt.show()
+    return final_ovec
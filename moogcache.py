@@ -0,0 +1,165 @@
+# This module has the on-disk cache of MOOG evaluations
+# Each entry holds the parsed summary_out (per-line results and averages) of one MOOG run, and it is found by
+# a hash of the atmospheric parameters, the line list and the other MOOG input files, and the MOOG input file settings.
+# The cache is shared by all analyses (reruns of a star, restarted surveys, several processes at the same time).
+import os
+import pickle
+import hashlib
+from tempfile import mkstemp
+import numpy as np
+from runcontext import read_par, outkeys, inkeys
+
+# === USER OPTIONS AREA ===
+
+# folder of the cache (None disables it)
+global cachedir; cachedir = os.path.join(os.path.expanduser('~'), '.cache', 'xiru')
+
+# maximum size of the cache in bytes; the least recently used entries are removed beyond it
+global maxbytes; maxbytes = 200*2**20
+
+# the whole cache is scanned for its size (and the oldest entries removed) only when the size estimated by this process
+# exceeds maxbytes, or after scanevery stores (entries written by other processes are counted by the scan);
+# the scan then removes entries until the cache is below keepfraction*maxbytes
+global scanevery; scanevery = 500
+global keepfraction; keepfraction = 0.9
+
+# number of decimals of the atmospheric parameters in the key
+global keydigits; keydigits = 6
+
+# === END OF USER OPTIONS AREA ===
+
+# hits and misses of this process, reported at exit
+global _stats; _stats = [0, 0]
+
+# size of the cache estimated by this process (None before the first scan), number of stores since the last scan,
+# and folder that was scanned
+global _size; _size = [None, 0, None]
+
+# digests of MOOG input files already read, by (file name, modification time, size)
+global _digests; _digests = {}
+
+def file_digest(fname):
+    "sha256 of the contents of a file"
+    st = os.stat(fname)
+    k = (os.path.realpath(fname), st.st_mtime_ns, st.st_size)
+    if k not in _digests:
+        h = hashlib.sha256()
+        f = open(fname, 'rb')
+        h.update(f.read())
+        f.close()
+        _digests[k] = h.hexdigest()
+    return _digests[k]
+
+def par_digest(par):
+    "Hash of the MOOG input file settings and of the contents of its input files (the line list, etc.)"
+    "The names of the files are left out, so that copies of the same input in other folders share the cache"
+    t, opts = read_par(par)
+    srcdir = os.path.dirname(os.path.abspath(par))
+    h = hashlib.sha256()
+    for line in t:
+        w = line.split(None, 1)
+        if len(w) == 2 and w[0] in outkeys:
+            continue
+        elif len(w) == 2 and w[0] in inkeys:
+            h.update((w[0] + ' ' + file_digest(os.path.join(srcdir, opts[w[0]]))).encode())
+        else:
+            h.update(' '.join(line.split()).encode())
+        h.update(b'\n')
+    return h.hexdigest()
+
+def eval_key(atmin, par, *extra):
+    "Key of the evaluation of the atmospheric parameters atmin with the MOOG input file par"
+    "extra: anything else the result depends on (model type, model grid, MOOG version)"
+    h = hashlib.sha256()
+    h.update(par_digest(par).encode())
+    for p in np.round(np.asarray(atmin, dtype=float), keydigits):
+        h.update(('%.*f ' % (keydigits, p + 0.)).encode())
+    for e in extra:
+        h.update(('\n' + str(e)).encode())
+    return h.hexdigest()
+
+def entry(key):
+    "File of a cache entry"
+    return os.path.join(cachedir, key[:2], key + '.pkl')
+
+def load(key):
+    "Returns the cached (lines, averages) of the key, or None if there is no such entry"
+    if cachedir == None:
+        return None
+    fname = entry(key)
+    try:
+        f = open(fname, 'rb')
+        data = pickle.load(f)
+        f.close()
+        os.utime(fname)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        _stats[1] += 1
+        return None
+    _stats[0] += 1
+    return data
+
+def store(key, data):
+    "Saves (lines, averages) under the key"
+    if cachedir == None:
+        return
+    fname = entry(key)
+    tmp = None
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        # written to a temporary file first, so that other processes never read a half-written entry
+        fd, tmp = mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, fname)
+    except OSError:
+        # e.g., a read-only or full home folder: the result is not cached, but the analysis goes on
+        if tmp != None and os.path.isfile(tmp):
+            os.remove(tmp)
+        return
+    _size[1] += 1
+    if _size[0] == None or _size[2] != cachedir or _size[0] + size > maxbytes or _size[1] >= scanevery:
+        evict()
+    else:
+        _size[0] += size
+
+def evict():
+    "Removes the least recently used entries if the cache is larger than maxbytes, until it is smaller than keepfraction*maxbytes"
+    "(so that the next scan is not due at the next store)"
+    files = []
+    for root, dirs, names in os.walk(cachedir):
+        for name in names:
+            if name.endswith('.pkl'):
+                fname = os.path.join(root, name)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, fname))
+    total = sum(f[1] for f in files)
+    if total > maxbytes:
+        files.sort()
+        for mtime, size, fname in files:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
+            if total <= keepfraction*maxbytes:
+                break
+    _size[:] = [total, 0, cachedir]
+
+def clear():
+    "Removes all entries"
+    if cachedir != None:
+        for root, dirs, names in os.walk(cachedir):
+            for name in names:
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(root, name))
+        _size[0] = None
+
+def report():
+    "Prints the hit rate of this process (registered with atexit by the command-line entry points, xiru.py and survey.py)"
+    n = _stats[0] + _stats[1]
+    if n > 0:
+        print('MOOG cache: %i hits, %i misses (hit rate %.0f%%)' % (_stats[0], _stats[1], 100.*_stats[0]/n))
@@ -1,23 +1,160 @@
-import os
 #from kurtype import run_kurtype_interpolator
-from interpolator import run_interpolator
+import moogcache
+import timing
+from backends import NativeModels, PythonModels, MoogRunner
 from custom_conv import run_custom_interpolator
+from parsemoog import MoogRun
+from runcontext import RunContext, moogpar
 
-def run_moog(moogpath='/path/to/MOOG'):
+# === USER OPTIONS AREA ===
+
+# path to the silent mode version of MOOG in your system (command-line arguments may follow it)
+global moogpath; moogpath = '/path/to/MOOG'
+
+# wall-clock limit in seconds for one MOOG run; a MOOG process that hangs is killed (None for no limit)
+global moogtimeout; moogtimeout = 600.
+
+# atmospheric models: 'kurucz' (native interpolator, interpolator.py), 'custom' (run_custom_interpolator in custom_conv.py),
+# or a model provider from backends.py, e.g. PythonModels(my_function) for an interpolator written in Python
+# (no process is started for each model) or CommandModels('my_interpolator {teff} {logg} {metal} {micro} {fout}')
+global provider; provider = 'kurucz'
+
+# runner of MOOG: None for the MOOG in moogpath, or a runner from backends.py (e.g., PythonRunner(my_function))
+global runner; runner = None
+
+# === END OF USER OPTIONS AREA ===
+
+# number of evaluations (including those taken from the MOOG cache) and of MOOG runs in this process
+global counts; counts = [0, 0]
+
+def start_moog(path=None, ctx=None, timeout=-1):
+    "Starts MOOG and returns immediately; several MOOG runs can be in flight at once if each one has its own RunContext"
+    "path: MOOG command (the runner from the user options area if None)"
+    "ctx: RunContext; if given, MOOG runs in its scratch directory, otherwise in the current folder"
+    "timeout: wall-clock limit in seconds for the MOOG run (moogtimeout if -1, no limit if None)"
+    "Returns a job (backends.MoogJob for MOOG itself); call its wait() method to get the result"
+    return get_runner(path, timeout).start(ctx)
+
+def run_moog(path=None, ctx=None, timeout=-1):
     "Basically...runs MOOG"
-    "The 'moogpath' string must be the path to MOOG in your system"
-    os.system('%s' % moogpath)
+    "path: MOOG command (the runner from the user options area if None)"
+    "ctx: RunContext; if given, MOOG runs in its scratch directory, otherwise in the current folder"
+    "timeout: wall-clock limit in seconds (moogtimeout if -1); a MOOG process that hangs is killed"
+    "Returns the finished job (backends.MoogJob for MOOG itself, with MOOG's captured output)"
+    with timing.phase('moog'):
+        return start_moog(path, ctx, timeout).wait()
 
-def run_model(atmin, modeltype='kurucz'):
-    "Runs the interpolator that creates the atmospheric model for MOOG using some grid"
-    
+def get_provider(modeltype=None, grid=None):
+    "Model provider for modeltype: 'kurucz', 'custom' or a model provider object (provider from the user options area if None)"
+    "grid: optional interpolator.ModelGrid instance for the native interpolator"
+    if modeltype == None:
+        modeltype = provider
     # if you are going to use castelli/kurucz models, a built-in interpolator is available for you :)
-    # if your favourite model grid is different (MARCS, etc.), edit the modeltype string in the method argument
-    # as well as the run_custom_interpolator method in custom_conv.py
+    # if your favourite model grid is different (MARCS, etc.), set provider in the user options area
+    # to a model provider from backends.py, or to 'custom' after editing run_custom_interpolator in custom_conv.py
     if modeltype == 'kurucz':
-        run_interpolator(atmin)
+        return NativeModels(grid)
     elif modeltype == 'custom':
-        run_custom_interpolator(atmin)
-    else:
+        return PythonModels(run_custom_interpolator, 'custom', writes=True)
+    elif isinstance(modeltype, str):
         print('Invalid option for model interpolator!')
-        raise SystemExit()
\ No newline at end of file
+        raise SystemExit()
+    return modeltype
+
+def get_runner(path=None, timeout=-1):
+    "Runner of MOOG: runner from the user options area, or a MoogRunner for moogpath if None"
+    "path, timeout: MOOG command and wall-clock limit of a MoogRunner used instead (moogtimeout if timeout is -1)"
+    if path == None and timeout == -1 and runner != None:
+        return runner
+    return MoogRunner(moogpath if path == None else path, moogtimeout if timeout == -1 else timeout)
+
+def concurrent():
+    "True if the runner can run MOOG for several sets of parameters at the same time (see evaluate_many)"
+    return get_runner().parallel == True
+
+def run_model(atmin, modeltype=None, grid=None, ctx=None):
+    "Creates the atmospheric model for MOOG with the model provider of modeltype (see get_provider)"
+    "grid: optional interpolator.ModelGrid instance for the native interpolator (if None, the grid is loaded once per process)"
+    "ctx: RunContext; if given, the model is written to its scratch directory, otherwise to MODEL in the current folder"
+    fout = 'MODEL' if ctx == None else ctx.model
+    
+    with timing.phase('model'):
+        get_provider(modeltype, grid).write(atmin, fout)
+
+def cache_key(atmin, modeltype=None, grid=None, ctx=None):
+    "Key of the evaluation in the MOOG cache (see moogcache.py)"
+    par = moogpar if ctx == None else ctx.par
+    extra = get_provider(modeltype, grid).key() + get_runner().key()
+    return moogcache.eval_key(atmin, par, *extra)
+
+def clamp_params(atmin, modeltype=None, grid=None):
+    "Nearest atmospheric parameters for which a model can be created (e.g., inside the model grid, non-negative microturbulence)"
+    return get_provider(modeltype, grid).clamp(atmin)
+
+def evaluate(atmin, fin='a.out', modeltype=None, grid=None, ctx=None):
+    "Creates the model, runs MOOG and parses its summary_out"
+    "Results are taken from the MOOG cache (see moogcache.py) if this evaluation was done before"
+    "fin MUST coincide with the summary_out in MOOG input file (ignored if a RunContext ctx is given)"
+    "Returns a MoogRun"
+    if ctx != None:
+        fin = ctx.summary
+    counts[0] += 1
+    with timing.phase('cache'):
+        key = cache_key(atmin, modeltype, grid, ctx)
+        data = moogcache.load(key)
+    if data != None:
+        return MoogRun(fin, atmin, data)
+    run_model(atmin, modeltype, grid, ctx)
+    run_moog(ctx=ctx)
+    counts[1] += 1
+    run = MoogRun(fin, atmin)
+    with timing.phase('cache'):
+        moogcache.store(key, (run.lines, run.averages))
+    return run
+
+def evaluate_many(atmins, modeltype=None, grid=None, ctx=None):
+    "Same as evaluate for several sets of atmospheric parameters, with all MOOG runs going on at the same time"
+    "Each run has its own scratch directory (children of ctx, or new contexts from the batch.par of the current folder if ctx is None)"
+    "Returns the list of MoogRun, in the same order as atmins"
+    counts[0] += len(atmins)
+    runs = [None]*len(atmins)
+    with timing.phase('cache'):
+        keys = [cache_key(atmin, modeltype, grid, ctx) for atmin in atmins]
+        for i in range(len(atmins)):
+            data = moogcache.load(keys[i])
+            if data != None:
+                runs[i] = MoogRun(ctx.summary if ctx != None else 'a.out', atmins[i], data)
+    todo = [i for i in range(len(atmins)) if runs[i] == None]
+    subs = [RunContext(moogpar) if ctx == None else ctx.child() for i in todo]
+    jobs = []
+    try:
+        models = get_provider(modeltype, grid)
+        if models.batch == True:
+            # all the models at once, before the MOOG runs
+            with timing.phase('model'):
+                models.write_many([atmins[i] for i in todo], [sub.model for sub in subs])
+        moog = get_runner()
+        for i, sub in zip(todo, subs):
+            if models.batch == False:
+                # one model at a time, so that MOOG already runs for the earlier ones while the next is created
+                with timing.phase('model'):
+                    models.write(atmins[i], sub.model)
+            if moog.parallel == True:
+                jobs.append(moog.start(sub))
+            else:
+                with timing.phase('moog'):
+                    jobs.append(moog.start(sub).wait())
+            counts[1] += 1
+        for i, sub, job in zip(todo, subs, jobs):
+            with timing.phase('moog'):
+                job.wait()
+            runs[i] = MoogRun(sub.summary, atmins[i])
+            with timing.phase('cache'):
+                moogcache.store(keys[i], (runs[i].lines, runs[i].averages))
+    finally:
+        for job in jobs:
+            if job.done() == False:
+                job.kill()
+        for sub in subs:
+            sub.cleanup()
+    return runs
@@ -1,153 +1,157 @@
 import numpy as np
 from scipy.stats import linregress
+import timing
 
-def mini_parse(skip_h, skip_f, spid, spstr, fin):
-    "Auxiliary method for parse_moog_out"
-    for i in range(len(spid)):
-        if spid[i] == spstr:
-            skip_idx = i
-            break
-    if spstr == 'Fe I':
-        sp = np.genfromtxt(fin,
-                           usecols=(2,5,6),
-                           skip_header=skip_h[skip_idx],
-                           skip_footer=skip_f[skip_idx])
-    else:
-        try:
-            sp = np.genfromtxt(fin,
-                           usecols=6,
-                           skip_header=skip_h[skip_idx],
-                           skip_footer=skip_f[skip_idx])
-        except:
-            sp = np.zeros(0)
-    return sp
+# columns of each line in the species blocks of MOOG's summary_out (abfind driver)
+lines_dtype = np.dtype([('wavelength', float), ('ID', float), ('EP', float), ('loggf', float),
+                        ('EW', float), ('RW', float), ('abund', float), ('delavg', float)])
+
+def parse_summary(fin='a.out'):
+    "Single-pass parser of MOOG's summary_out file"
+    "Returns two dicts keyed by species name (e.g. 'Fe I'):"
+    "lines: record array with the fields of lines_dtype (wavelength, ID, EP, loggf, EW, RW, abund, delavg), one record per line"
+    "averages: values of the 'average abundance' and correlation lines (abund, std, nlines, epslope, rwslope, wavslope)"
+    "If a species appears in more than one block, only the first block is kept"
+    f = open(fin, 'r')
+    t = f.read().splitlines()
+    f.close()
+    rows = {}; averages = {}
+    sp = None; inblock = False
+    ncols = len(lines_dtype.names)
+    for line in t:
+        if 'Abundance Results for Species' in line:
+            w = line.split()
+            sp = w[4]+' '+w[5]
+            if sp in rows:
+                sp = None
+            else:
+                rows[sp] = []; averages[sp] = {}
+            inblock = True
+        elif sp == None:
+            continue
+        elif 'average abundance' in line:
+            w = line.split()
+            averages[sp]['abund'] = float(w[3])
+            try:
+                averages[sp]['std'] = float(w[7])
+                averages[sp]['nlines'] = int(w[-1].split('=')[-1])
+            except (IndexError, ValueError):
+                pass
+            inblock = False
+        elif 'correlation:' in line:
+            w = line.split()
+            key = {'E.P.': 'epslope', 'R.W.': 'rwslope', 'wav.': 'wavslope'}.get(w[0])
+            if key != None:
+                averages[sp][key] = float(w[w.index('slope')+2])
+        elif inblock:
+            try:
+                v = [float(x) for x in line.split()]
+            except ValueError:
+                continue # column titles or a message from MOOG
+            if len(v) >= 7:
+                rows[sp].append((v + [np.nan]*ncols)[:ncols])
+    lines = {}
+    for sp in rows:
+        data = np.array(rows[sp], dtype=float).reshape(-1, ncols)
+        lines[sp] = np.rec.fromarrays(data.T, dtype=lines_dtype)
+    return lines, averages
+
+class MoogRun:
+    "Results of one MOOG run: the parsed summary_out and the observables derived from it"
+    "Passed to the convergence, error and plotting steps instead of the file name, so that summary_out is read only once"
+    
+    def __init__(self, fin='a.out', atmpar=None, data=None):
+        "data: (lines, averages) as returned by parse_summary, if already available (fin is then not read)"
+        self.fin = fin
+        self.atmpar = None if atmpar is None else np.array(atmpar, dtype=float)
+        if data == None:
+            with timing.phase('parse'):
+                data = parse_summary(fin)
+        self.lines, self.averages = data
+        self.ovec = None # observables vector used in the convergence, set by the solver
+    
+    def observables(self, minput, **kwargs):
+        "Same as parse_moog_out for this run"
+        with timing.phase('observables'):
+            return parse_moog_out(minput, fin=self, **kwargs)
+    
+    def diff_observables(self, fe1ref, fe2ref, mh, refmh, mkplot=False):
+        "Same as diff_ovec for this run"
+        with timing.phase('observables'):
+            return diff_ovec(self, fe1ref, fe2ref, mh, refmh, mkplot)
+    
+    def fe(self):
+        "Same as parse_moog_fe for this run"
+        return lines_array(self.lines['Fe I']), lines_array(self.lines['Fe II'])
+
+def moog_run(fin):
+    "Returns fin if it is already a MoogRun, otherwise parses the summary_out file fin"
+    if isinstance(fin, MoogRun):
+        return fin
+    return MoogRun(fin)
+
+def lines_array(rec):
+    "Converts a record array from parse_summary to a 2D array (line, column), columns ordered as in summary_out"
+    return np.column_stack([rec[name] for name in lines_dtype.names])
 
 def parse_moog_out(minput, feI=True, feII=True, alpha=True, native=True, final=False, fesolar=7.50, mgsolar=7.60, sisolar=7.51, casolar=6.34, fin='a.out'):
     "This method retrieves information from MOOG's summary_out file"
     "Returns the convergence parameters EP slope, RW slope, difference in FeI/II abundances and difference between model and estimated metallicity"
     "If alpha-enhancement is considered it returns alpha and Fe abundances separately"
     "Solar abundances from Asplund et al. 2009ARA&A..47..481A"
-    "The 'fin' variable MUST coincide with the summary_out in MOOG input file"
+    "The 'fin' variable MUST coincide with the summary_out in MOOG input file, or be a MoogRun"
     asol = np.array([mgsolar, sisolar, casolar])
-    f = open(fin, 'r')
-    t = f.readlines()
-    f.close()
+    run = moog_run(fin)
+    lines, averages = run.lines, run.averages
     if native == False:
-        N = len(t)
-        spnames = []
-        avabd = []
-        idxl = []
-        for i in range(N):
-            if 'Abundance Results for Species' in t[i]:
-                spnames.append(t[i])
-            if 'average abundance' in t[i]:
-                avabd.append(t[i])
-                idxl.append(i)
+        # average abundances and slopes as printed by MOOG
         if feI == True:
-            for i in range(len(spnames)):
-                ionid = spnames[i].split()[4]+' '+spnames[i].split()[5]
-                if ionid == 'Fe I':
-                    fe1 = float(avabd[i].split()[3])
-                    epslope = float(t[idxl[i]+1].split()[4])
-                    rwslope = float(t[idxl[i]+2].split()[4])
-                    break
+            fe1 = averages['Fe I']['abund']
+            epslope = averages['Fe I']['epslope']
+            rwslope = averages['Fe I']['rwslope']
             feh = fe1 - fesolar
         else:
             return None, None, None, None
         if feII == True:
-            for i in range(len(spnames)):
-                ionid = spnames[i].split()[4]+' '+spnames[i].split()[5]
-                if ionid == 'Fe II':
-                    fe2 = float(avabd[i].split()[3])
-                    break
+            fe2 = averages['Fe II']['abund']
             gparam = fe1 - fe2
         else:
             gparam = None
         if alpha == True:
-            mg = None; si = None; ca = None
-            for i in range(len(spnames)):
-                ionid = spnames[i].split()[4]+' '+spnames[i].split()[5]
-                if ionid == 'Mg I':
-                    mg = float(avabd[i].split()[3])
-                if ionid == 'Si I':
-                    si = float(avabd[i].split()[3])
-                if ionid == 'Ca I':
-                    ca = float(avabd[i].split()[3])
-                    break # needs alpha elements to be ordered by atomic number
-            alphal = [mg, si, ca]
-            try:
-                ahl = alphal - asol
-            except:
-                for i in range(len(alphal)-1, -1, -1):
-                    if alphal[i] == None:
-                        del alphal[i]
-                        asol = np.delete(asol, i)
-                ahl = alphal - asol
-            afel = ahl - feh
+            alphal = []; asel = []
+            for k, ionid in enumerate(['Mg I', 'Si I', 'Ca I']):
+                if ionid in averages:
+                    alphal.append(averages[ionid]['abund'])
+                    asel.append(asol[k])
+            afel = np.asarray(alphal) - np.asarray(asel) - feh
             afe = np.mean(afel)
             deltam = np.log10(0.638*10.**afe + 0.362)
             mparam = np.around(feh + deltam - minput, decimals=3)
         else:
             mparam = np.around(feh - minput, decimals=3)
     else:
-        skip_h = []
-        skip_f = []
-        spid = []
-        hcounter = 0
-        fcounter = 0
-        for i in range(len(t)):
-            if 'Abundance Results for Species' in t[i]:
-                hcounter = hcounter + 1
-                skip_h.append(i+hcounter+1)
-                ion = t[i].split()[4]+' '+t[i].split()[5]
-                spid.append(ion)
-            if 'average abundance' in t[i]:
-                skip_f.append(len(t)-i)
-        offset_h = np.arange(len(spid))
-        offset_f = np.arange(len(spid)-1, -1, -1)
-        skip_h = np.asarray(skip_h) - offset_h
-        skip_f = np.asarray(skip_f) - offset_f
+        # slopes and averages computed from the individual lines
         if feI == True:
-            fe1 = mini_parse(skip_h, skip_f, spid, 'Fe I', fin)
-        if feII == True:
-            fe2 = mini_parse(skip_h, skip_f, spid, 'Fe II', fin)
-        if alpha == True:
-            mg = mini_parse(skip_h, skip_f, spid, 'Mg I', fin)
-            si = mini_parse(skip_h, skip_f, spid, 'Si I', fin)
-            if si.shape != () and si.shape[0] == 0:
-                si = mini_parse(skip_h, skip_f, spid, 'Si II', fin)
-            ca = mini_parse(skip_h, skip_f, spid, 'Ca I', fin)
-        epslope = np.around(linregress(fe1[:,0], fe1[:,2])[0], decimals=4)
-        rwslope = np.around(linregress(fe1[:,1], fe1[:,2])[0], decimals=4)
-        fe1_mean = np.mean(fe1[:,2])
+            fe1 = lines['Fe I']
+        else:
+            return None, None, None, None
+        epslope = np.around(linregress(fe1['EP'], fe1['abund'])[0], decimals=4)
+        rwslope = np.around(linregress(fe1['RW'], fe1['abund'])[0], decimals=4)
+        fe1_mean = np.mean(fe1['abund'])
         feh = fe1_mean - fesolar
         if feII == True:
-            gparam = np.around(fe1_mean - np.mean(fe2), decimals=4)
+            gparam = np.around(fe1_mean - np.mean(lines['Fe II']['abund']), decimals=4)
         else:
             gparam = None
         if alpha == True:
-            prealpha = [mg, si, ca]; alphal = []; alphadelarg = []
-            for i in range(len(prealpha)):
-                if prealpha[i].shape != () and prealpha[i].shape[0] == 0:
-                    alphadelarg.append(i)
-                else:
-                    alphal.append(prealpha[i])
-            if len(alphadelarg) > 0:
-                asol = np.delete(asol, alphadelarg)
-            for i in range(len(alphal)):
-                try:
-                    alphal[i] = np.mean(alphal[i])
-                except:
-                    pass
-            try:
-                ahl = alphal - asol
-            except:
-                for i in range(len(alphal)-1, -1, -1):
-                    if alphal[i] == None:
-                        del alphal[i]
-                        asol = np.delete(asol, i)
-                ahl = alphal - asol
-            afel = ahl - feh
+            alphal = []; asel = []
+            for k, ionid in enumerate(['Mg I', 'Si I', 'Ca I']):
+                if ionid == 'Si I' and (ionid not in lines or lines[ionid].shape[0] == 0):
+                    ionid = 'Si II'
+                if ionid in lines and lines[ionid].shape[0] > 0:
+                    alphal.append(np.mean(lines[ionid]['abund']))
+                    asel.append(asol[k])
+            afel = np.asarray(alphal) - np.asarray(asel) - feh
             afe = np.mean(afel)
             deltam = np.log10(0.684*10.**afe + (1.-0.684))
             mparam = np.around(feh + deltam - minput, decimals=4)
@@ -160,48 +164,26 @@ def parse_moog_out(minput, feI=True, feII=True, alpha=True, native=True, final=F
 
 def parse_moog_fe(fin):
     "Gets MOOG output for Fe lines only"
-    f = open(fin, 'r')
-    t = f.readlines()
-    f.close()
-    skip_h = []
-    skip_f = []
-    spid = []
-    hcounter = 0
-    for i in range(len(t)):
-        if 'Abundance Results for Species' in t[i]:
-            hcounter = hcounter + 1
-            skip_h.append(i+hcounter+1)
-            ion = t[i].split()[4]+' '+t[i].split()[5]
-            spid.append(ion)
-        if 'average abundance' in t[i]:
-            skip_f.append(len(t)-i)
-    offset_h = np.arange(len(spid))
-    offset_f = np.arange(len(spid)-1, -1, -1)
-    skip_h = np.asarray(skip_h) - offset_h
-    skip_f = np.asarray(skip_f) - offset_f
-    for i in range(len(spid)):
-        if spid[i] == 'Fe I':
-            fe1idx = i
-        if spid[i] == 'Fe II':
-            fe2idx = i
-    fe1data = np.genfromtxt(fin, skip_header=skip_h[fe1idx], skip_footer=skip_f[fe1idx])
-    fe2data = np.genfromtxt(fin, skip_header=skip_h[fe2idx], skip_footer=skip_f[fe2idx])
-    return fe1data, fe2data
+    "fin is the summary_out file name or a MoogRun"
+    "Returns two 2D arrays (line, column) for Fe I and Fe II, columns ordered as in summary_out"
+    return moog_run(fin).fe()
 
 def diff_ovec(stdout, fe1ref, fe2ref, mh, refmh, mkplot=False):
     "Generates differential ovec, i.e., the vector of the minization parameters, but with respect to the reference star"
-    fe1data, fe2data = parse_moog_fe(stdout)
-    dfe1 = fe1data[:,6] - fe1ref
-    dfe2 = fe2data[:,6] - fe2ref
+    "stdout is the summary_out file name or a MoogRun"
+    run = moog_run(stdout)
+    fe1data = run.lines['Fe I']; fe2data = run.lines['Fe II']
+    dfe1 = fe1data['abund'] - fe1ref
+    dfe2 = fe2data['abund'] - fe2ref
     dfe1m = np.mean(dfe1)
     dfe2m = np.mean(dfe2)
-    epsl = linregress(fe1data[:,2], dfe1)[0]
-    rwsl = linregress(fe1data[:,5], dfe1)[0]
+    epsl = linregress(fe1data['EP'], dfe1)[0]
+    rwsl = linregress(fe1data['RW'], dfe1)[0]
     gpar = dfe1m - dfe2m
-    mpar = np.mean(fe1data[:,6]) - np.mean(fe1ref) - mh + refmh
+    mpar = np.mean(fe1data['abund']) - np.mean(fe1ref) - mh + refmh
     if mkplot == False:
         return epsl, gpar, mpar, rwsl
     else:
-        epint = linregress(fe1data[:,2], dfe1)[1]
-        rwint = linregress(fe1data[:,5], dfe1)[1]
-        return epsl, gpar, mpar, rwsl, dfe1, dfe2, fe1data[:,2], fe1data[:,5], fe2data[:,5], epint, rwint
+        epint = linregress(fe1data['EP'], dfe1)[1]
+        rwint = linregress(fe1data['RW'], dfe1)[1]
+        return epsl, gpar, mpar, rwsl, dfe1, dfe2, fe1data['EP'], fe1data['RW'], fe2data['RW'], epint, rwint
@@ -0,0 +1,117 @@
+# This module has the run context, i.e., the set of files used by one analysis (or by one MOOG call)
+# Each context owns a scratch directory with its own MOOG input file (batch.par), model and summary_out,
+# so that several analyses or MOOG runs can share the same star folder at the same time
+import os
+import shutil
+from tempfile import mkdtemp
+
+# MOOG (silent mode) always reads its input from 'batch.par' in the directory where it runs
+global moogpar; moogpar = 'batch.par'
+
+# keys of the MOOG input file that point to files written by MOOG (or by the interpolator) and to files read by MOOG
+global outkeys; outkeys = ['model_in', 'summary_out', 'standard_out', 'smoothed_out', 'raw_out', 'iraf_out', 'dump_out']
+global inkeys; inkeys = ['lines_in', 'observed_in', 'obspectrum_in']
+
+def read_par(fin):
+    "Reads a MOOG input file"
+    "Returns the list of lines and a dict with the (unquoted) value of each key"
+    f = open(fin, 'r')
+    t = f.read().splitlines()
+    f.close()
+    opts = {}
+    for line in t:
+        w = line.split(None, 1)
+        if len(w) == 2:
+            opts[w[0]] = w[1].strip().strip('\'"')
+    return t, opts
+
+class RunContext:
+    "Scratch directory for one analysis, with its own copy of the MOOG input file"
+    "par: MOOG input file used as template (file names of input data are relative to the folder where it is)"
+    "scratch: folder where the scratch directory is created (system temporary folder if None)"
+    "outdir: folder where the results (atmparam, unc_atmparam, Jacobian, plots) are saved (current folder if None)"
+    "keep: if True, the scratch directory is not removed by cleanup()"
+    "lines: line list used instead of the lines_in of the template (path relative to the current folder)"
+    "save: if False, no result files are written (output() returns None)"
+
+    def __init__(self, par='batch.par', scratch=None, outdir=None, keep=False, lines=None, save=True):
+        self.template = os.path.abspath(par)
+        self.scratch = scratch
+        self.outdir = os.path.abspath('.' if outdir == None else outdir)
+        self.keep = keep
+        self.save = save
+        self.lines = None if lines == None else os.path.abspath(lines)
+        self.parent = None
+        self.dir = mkdtemp(prefix='xiru_', dir=scratch)
+        self.par = os.path.join(self.dir, moogpar)
+        t, opts = read_par(self.template)
+        srcdir = os.path.dirname(self.template)
+        s = []
+        for line in t:
+            w = line.split(None, 1)
+            if len(w) == 2 and (w[0] in outkeys or w[0] in inkeys):
+                value = w[1].strip()
+                if w[0] == 'lines_in' and self.lines != None:
+                    value = self.lines
+                quote = value[0] if value[0] in '\'"' else ''
+                fname = os.path.basename(value.strip('\'"'))
+                if w[0] in inkeys:
+                    # input data are linked into the scratch directory: MOOG only accepts short file names
+                    self.link(os.path.join(srcdir, value.strip('\'"')), fname)
+                line = '%-12s %s%s%s' % (w[0], quote, fname, quote)
+            s.append(line)
+        f = open(self.par, 'w')
+        f.write('\n'.join(s) + '\n')
+        f.close()
+        t, self.opts = read_par(self.par)
+        self.model = os.path.join(self.dir, self.opts.get('model_in', 'MODEL'))
+        self.summary = os.path.join(self.dir, self.opts.get('summary_out', 'a.out'))
+        self.stdout = os.path.join(self.dir, self.opts['standard_out']) if 'standard_out' in self.opts else None
+
+    def link(self, src, fname):
+        "Makes the file src available in the scratch directory as fname"
+        dst = os.path.join(self.dir, fname)
+        if os.path.exists(dst):
+            return
+        try:
+            os.symlink(os.path.abspath(src), dst)
+        except OSError:
+            shutil.copy(src, dst)
+
+    def child(self):
+        "New context with the same MOOG input file, for another MOOG run going on at the same time"
+        "(its standard_out is handed over to this context by cleanup(), see save_log)"
+        c = RunContext(self.template, self.scratch, self.outdir, self.keep, self.lines, self.save)
+        c.parent = self
+        return c
+
+    def output(self, fname):
+        "Path of a result file (None if result files are not saved)"
+        if self.save == False:
+            return None
+        return os.path.join(self.outdir, fname)
+
+    def save_log(self):
+        "Copies MOOG's standard_out of the last run (in this context or in one of its children) to the output folder"
+        if self.save == False or self.stdout == None or not os.path.isfile(self.stdout):
+            return
+        try:
+            shutil.copy(self.stdout, self.output(os.path.basename(self.stdout)))
+        except OSError:
+            pass
+
+    def cleanup(self):
+        "Removes the scratch directory (the standard_out of a child context is moved to its parent first)"
+        if self.keep == False:
+            if self.parent != None and self.stdout != None and self.parent.stdout != None and os.path.isfile(self.stdout):
+                try:
+                    os.replace(self.stdout, self.parent.stdout)
+                except OSError:
+                    pass
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
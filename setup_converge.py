@@ -2,8 +2,20 @@
 import numpy as np
 from scipy.stats import linregress
 from argparse import ArgumentParser
-from moognmodels import run_moog, run_model
-from parsemoog import parse_moog_out, parse_moog_fe, diff_ovec
+from moognmodels import evaluate, evaluate_many, clamp_params
+from jacobian import nearest_jacobian
+
+# === USER OPTIONS AREA ===
+
+# initial Jacobian: 'cmatrix' (built-in guess, updated with two MOOG runs),
+# 'fd' (finite differences: the first guess and four perturbed points, all MOOG runs at the same time) or
+# 'library' (Jacobians of converged stars with parameters near the first guess, see jacobian.py; one MOOG run)
+global jacinit; jacinit = 'cmatrix'
+
+# finite-difference steps of Teff, logg, [M/H] and vt (used if jacinit = 'fd')
+global fdsteps; fdsteps = [50., 0.1, 0.05, 0.1]
+
+# === END OF USER OPTIONS AREA ===
 
 def initial_options():
     "Returns info from command-line arguments"
@@ -12,11 +24,13 @@ def initial_options():
     parser.add_argument('-p', '--plot', help='Plot iteration history.', action='store_true')
     parser.add_argument('-a', '--alpha', action='store_true', help='Correct for alpha abundances using the Salaris formula. Disabled for differential analysis.')
     parser.add_argument('-d', '--differential', action='store_true', help='Differential analysis. Reference star input file must be named reference.moog.')
+    parser.add_argument('-j', '--jacobian', choices=['cmatrix', 'fd', 'library'], default=None, help='Initial Jacobian: built-in guess, finite differences or library of converged stars (default: jacinit in setup_converge.py).')
+    parser.add_argument('-s', '--solver', default=None, help='Solver strategy: broyden, badbroyden, invbroyden, newton or lm (default: strategy in solver.py).')
     args = parser.parse_args()
     
     makeplot  = args.plot
     argsalpha = args.alpha
-    return args.p0, makeplot, argsalpha, args.differential
+    return args.p0, makeplot, argsalpha, args.differential, args.jacobian, args.solver
 
 def cmatrix():
     "Initial guess of the jacobian"
@@ -28,9 +42,28 @@ def cmatrix():
     
     return c
 
+def initial_mode(jinit=None):
+    "Checks the choice of initial Jacobian"
+    if jinit == None:
+        jinit = jacinit
+    if jinit not in ['cmatrix', 'fd', 'library']:
+        print('Invalid option for initial Jacobian!')
+        raise SystemExit()
+    return jinit
+
+def library_jacobian(p, kind='standard'):
+    "Starting Jacobian from the library of converged stars (None if there is no stored Jacobian near p)"
+    J = nearest_jacobian(p, kind)
+    if J is None:
+        print('Jacobian library: no converged star near the first guess, using the built-in Jacobian')
+    elif np.linalg.matrix_rank(J) < 4:
+        print('Jacobian library: singular Jacobian near the first guess, using the built-in Jacobian')
+        J = None
+    return J
+
 def setup_atmpar(p0):
     "Configure iterations 0 and 1 of the atmospheric parameters"
-    if p0 != None:
+    if p0 is not None:
         if len(p0) == 4:
             p_new = np.array(p0)
         else:
@@ -39,57 +72,121 @@ def setup_atmpar(p0):
     else:
         p_new = np.array([4300., 1.60, -0.55, 1.72])
     
-    p1 = p_new + np.array([1.,0.001,0.001,0.001])
+    # (stepping back from the upper edges of the model grid)
+    p1 = p_new + fd_steps(p_new, [1.,0.001,0.001,0.001])
     return p_new, p1
 
-def std_anal_init(p0, argsalpha, ovec_ref=np.zeros(4)):
+def std_anal_init(p0, argsalpha, ovec_ref=np.zeros(4), ctx=None, jinit=None):
     "Initialisation for a non-differential (standard) analysis"
+    "jinit: 'cmatrix', 'fd' or 'library' (jacinit if None)"
+    jinit = initial_mode(jinit)
+    def observe(run, p):
+        return np.asarray(run.observables(p[2], alpha=argsalpha, native=True)) - ovec_ref
+    if jinit == 'fd':
+        p_new = setup_atmpar(p0)[0]
+        Jn, ovec, run = jacobian_fd(p_new, observe, ctx=ctx)
+        return p_new, Jn, ovec, p_new, np.linalg.norm(ovec), run
+    elif jinit == 'library':
+        p_new = setup_atmpar(p0)[0]
+        Jn = library_jacobian(p_new, 'alpha' if argsalpha == True else 'standard')
+        if Jn is not None:
+            run = evaluate(p_new, ctx=ctx)
+            run.ovec = observe(run, p_new)
+            return p_new, Jn, run.ovec, p_new, np.linalg.norm(run.ovec), run
+    
     C = cmatrix()
     Cinv = np.linalg.inv(C)
     
     p_new, p1 = setup_atmpar(p0)
     
-    Jn, ovec = jacobian_initial_update(C, p_new, p1, argsalpha, ovec_ref)
+    Jn, ovec, run = jacobian_initial_update(C, p_new, p1, argsalpha, ovec_ref, ctx)
     pn = p1
     quadr = np.linalg.norm(ovec)
-    return p1, Jn, ovec, pn, quadr
+    return p1, Jn, ovec, pn, quadr, run
 
-def jacobian_initial_update(J0, x0, x1, args_alpha, ovec_ref):
+def jacobian_initial_update(J0, x0, x1, args_alpha, ovec_ref, ctx=None):
     "Creates the first iteration of the Jacobian (standard analysis)"
-    run_model(x0)
-    run_moog()
-    ovec0 = np.asarray(parse_moog_out(x0[2], alpha=args_alpha, native=True)) - ovec_ref
-    run_model(x1)
-    run_moog()
-    ovec1 = np.asarray(parse_moog_out(x1[2], alpha=args_alpha, native=True)) - ovec_ref
+    "Returns the Jacobian, the observables at x1 and the MoogRun at x1"
+    run0 = evaluate(x0, ctx=ctx)
+    ovec0 = np.asarray(run0.observables(x0[2], alpha=args_alpha, native=True)) - ovec_ref
+    run1 = evaluate(x1, ctx=ctx)
+    ovec1 = np.asarray(run1.observables(x1[2], alpha=args_alpha, native=True)) - ovec_ref
+    run1.ovec = ovec1
     deltao = ovec1-ovec0
     deltax = x1-x0
     deltaJ = np.outer((deltao - np.dot(J0,deltax)), deltax.reshape(1,4))/np.dot(deltax,deltax)
     J1 = J0 + deltaJ
-    return J1, ovec1
+    return J1, ovec1, run1
 
-def dif_anal_init(p0, fe1ref, fe2ref, refmh):
+def dif_anal_init(p0, fe1ref, fe2ref, refmh, ctx=None, jinit=None):
     "Initialisation for a differential analysis"
+    "jinit: 'cmatrix', 'fd' or 'library' (jacinit if None)"
+    jinit = initial_mode(jinit)
+    def observe(run, p):
+        return np.asarray(run.diff_observables(fe1ref, fe2ref, p[2], refmh))
+    if jinit == 'fd':
+        p_new = setup_atmpar(p0)[0]
+        Jn, ovec, run = jacobian_fd(p_new, observe, ctx=ctx)
+        return p_new, Jn, ovec, p_new, np.linalg.norm(ovec), run
+    elif jinit == 'library':
+        p_new = setup_atmpar(p0)[0]
+        Jn = library_jacobian(p_new, 'differential')
+        if Jn is not None:
+            run = evaluate(p_new, ctx=ctx)
+            run.ovec = observe(run, p_new)
+            return p_new, Jn, run.ovec, p_new, np.linalg.norm(run.ovec), run
+    
     C = cmatrix()
     Cinv = np.linalg.inv(C)
     
     p_new, p1 = setup_atmpar(p0)
     
-    Jn, ovec = jacobian_initial_differential_update(C, p_new, p1, fe1ref, fe2ref, refmh)
+    Jn, ovec, run = jacobian_initial_differential_update(C, p_new, p1, fe1ref, fe2ref, refmh, ctx=ctx)
     pn = p1
     quadr = np.linalg.norm(ovec)
-    return p1, Jn, ovec, pn, quadr
+    return p1, Jn, ovec, pn, quadr, run
 
-def jacobian_initial_differential_update(J0, x0, x1, fe1ref, fe2ref, refmh, stdout='a.out'):
+def jacobian_initial_differential_update(J0, x0, x1, fe1ref, fe2ref, refmh, stdout='a.out', ctx=None):
     "Creates the first iteration of the Jacobian (differential analysis)"
-    run_model(x0)
-    run_moog()
-    ovec0 = np.asarray(diff_ovec(stdout, fe1ref, fe2ref, x0[2], refmh))
-    run_model(x1)
-    run_moog()
-    ovec1 = np.asarray(diff_ovec(stdout, fe1ref, fe2ref, x1[2], refmh))
+    "Returns the Jacobian, the observables at x1 and the MoogRun at x1"
+    run0 = evaluate(x0, stdout, ctx=ctx)
+    ovec0 = np.asarray(run0.diff_observables(fe1ref, fe2ref, x0[2], refmh))
+    run1 = evaluate(x1, stdout, ctx=ctx)
+    ovec1 = np.asarray(run1.diff_observables(fe1ref, fe2ref, x1[2], refmh))
+    run1.ovec = ovec1
     deltao = ovec1-ovec0
     deltax = x1-x0
     deltaJ = np.outer((deltao - np.dot(J0,deltax)), deltax.reshape(1,4))/np.dot(deltax,deltax)
     J1 = J0 + deltaJ
-    return J1, ovec1
+    return J1, ovec1, run1
+
+def fd_steps(x0, steps=None, clamp=None):
+    "Finite-difference steps at x0: forward, or backward (negative) on the axes where x0 plus the step leaves the model grid"
+    "steps: steps of Teff, logg, [M/H] and vt (fdsteps if None)"
+    "clamp: function that returns the nearest valid atmospheric parameters (clamp_params in moognmodels.py if None)"
+    if clamp == None:
+        clamp = clamp_params
+    h = np.array(fdsteps if steps is None else steps, dtype=float)
+    for i in range(4):
+        p = x0 + h[i]*np.eye(4)[i]
+        if np.any(np.abs(np.asarray(clamp(p)) - p) > 1e-9*np.abs(h)):
+            h[i] = -h[i]
+    return h
+
+def jacobian_fd(x0, observe, steps=None, ctx=None):
+    "Finite-difference Jacobian at x0 (forward differences, backward at the upper edges of the model grid)"
+    "The MOOG runs at x0 and at the four perturbed points go on at the same time, so this takes about as long as one run"
+    "observe: function of (MoogRun, atmospheric parameters) that returns the observables vector"
+    "steps: steps of Teff, logg, [M/H] and vt (fdsteps if None)"
+    "Returns the Jacobian, the observables at x0 and the MoogRun at x0"
+    x0 = np.asarray(x0, dtype=float)
+    h = fd_steps(x0, steps)
+    points = [x0] + [x0 + h[i]*np.eye(4)[i] for i in range(4)]
+    runs = evaluate_many(points, ctx=ctx)
+    ovecs = [np.asarray(observe(run, p)) for run, p in zip(runs, points)]
+    J = np.column_stack([(ovecs[i+1] - ovecs[0])/h[i] for i in range(4)])
+    if np.linalg.matrix_rank(J) < 4:
+        print('Finite-difference Jacobian is singular! Try larger steps (fdsteps in setup_converge.py).')
+        raise SystemExit()
+    runs[0].ovec = ovecs[0]
+    return J, ovecs[0], runs[0]
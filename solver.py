@@ -0,0 +1,277 @@
+# This module has the solver that converges the atmospheric parameters, for both standard and differential analyses
+# The observables come from a function of the atmospheric parameters, so the solver does not depend on the kind of analysis.
+# Root-finding strategies:
+# broyden: Broyden's method (the "good" update of the Jacobian)
+# badbroyden: Broyden's "bad" method (update of the inverse Jacobian)
+# invbroyden: Broyden's method with the inverse Jacobian updated by the Sherman-Morrison formula (no linear system to solve)
+# newton: Newton's method with a finite-difference Jacobian in each iteration (4 extra MOOG runs per iteration, at the same time)
+# lm: Levenberg-Marquardt steps with the Jacobian updated as in Broyden's method; steps that increase the quadrature are rejected
+import os
+import time
+import numpy as np
+import moognmodels
+import moogcache
+import timing
+import setup_converge
+from jacobian import jacobian_update
+from surrogate import Surrogate
+
+# === USER OPTIONS AREA ===
+
+# root-finding strategy (see above)
+global strategy; strategy = 'broyden'
+
+# convergence: quadrature of the observables below tolquadr, or change of the quadrature below tolchange, or maxiter iterations
+global tolquadr; tolquadr = 0.001
+global tolchange; tolchange = 1e-7
+global maxiter; maxiter = 20
+
+# initial damping of the Levenberg-Marquardt steps
+global lmdamping; lmdamping = 1e-3
+
+# step globalization:
+# None: full steps
+# 'linesearch': backtracking, the step is halved (up to maxbacktrack times, one MOOG run each) while the quadrature grows
+# 'trustregion': steps are limited to a region that shrinks when the quadrature grows (the step is then rejected)
+# and grows when the quadrature falls as predicted by the Jacobian
+global globalization; globalization = None
+global maxbacktrack; maxbacktrack = 3
+
+# largest step of Teff, logg, [M/H] and vt in one iteration, with linesearch or trustregion (initial size of the trust region)
+global maxstep; maxstep = [300., 0.5, 0.3, 0.5]
+
+# if True, steps that would leave the model grid stop at its edge instead of aborting the analysis
+global clampgrid; clampgrid = True
+
+# if True, each iteration runs MOOG at the same time (in separate scratch directories) for several candidate steps:
+# the step times each of specfactors, and the step given by an alternative estimate of the Jacobian (the other Broyden update);
+# the best candidate is kept and all of them update the Jacobian (speculative mode: fewer iterations, using idle cores)
+global speculative; speculative = False
+global specfactors; specfactors = [1., 0.5, 1.5]
+
+# if True, candidate steps are screened with a surrogate model of the observables (see surrogate.py) before MOOG is run
+global usesurrogate; usesurrogate = False
+
+# === END OF USER OPTIONS AREA ===
+
+global strategies; strategies = ['broyden', 'badbroyden', 'invbroyden', 'newton', 'lm']
+
+def check_globalization(glob=-1):
+    "Checks the choice of step globalization"
+    if glob == -1:
+        glob = globalization
+    if glob not in [None, 'linesearch', 'trustregion']:
+        print('Invalid option for step globalization!')
+        raise SystemExit()
+    return glob
+
+def limit_step(delta_p, size):
+    "Shortens the step (keeping its direction) so that no parameter changes by more than size"
+    r = np.max(np.abs(delta_p)/size)
+    if r > 1.:
+        return delta_p/r
+    return delta_p
+
+def check_strategy(method=None):
+    "Checks the choice of strategy"
+    if method == None:
+        method = strategy
+    if method not in strategies:
+        print('Invalid option for solver strategy!')
+        raise SystemExit()
+    return method
+
+def bad_broyden_update(H, dx, df):
+    "Updates the inverse Jacobian using Broyden's bad method"
+    return H + np.outer(dx - np.dot(H, df), df)/np.dot(df, df)
+
+def sherman_morrison_update(H, dx, df):
+    "Updates the inverse Jacobian as the inverse of the good Broyden update (Sherman-Morrison formula)"
+    Hdf = np.dot(H, df)
+    return H + np.outer(dx - Hdf, np.dot(dx, H))/np.dot(dx, Hdf)
+
+def fd_jacobian(observe_many, p, ovec, steps=None, clamp=None):
+    "Finite-difference Jacobian at p (forward differences, backward at the upper edges of the model grid),"
+    "with the MOOG runs of the four perturbed points at the same time"
+    "steps: steps of Teff, logg, [M/H] and vt (fdsteps in setup_converge.py if None)"
+    "clamp: function that returns the nearest valid atmospheric parameters (clamp_params in moognmodels.py if None)"
+    h = setup_converge.fd_steps(p, steps, clamp)
+    runs = observe_many([p + h[i]*np.eye(4)[i] for i in range(4)])
+    return np.column_stack([(runs[i].ovec - ovec)/h[i] for i in range(4)])
+
+def solve(observe, pn, Jn, ovec, run=None, method=None, observe_many=None, steps=None, callback=None, clamp=None, glob=-1, surr=None, spec=None, records=None):
+    "Converges the atmospheric parameters, starting at pn (observables ovec) with the Jacobian Jn"
+    "observe: function of the atmospheric parameters that returns the MoogRun there, with its observables vector in .ovec"
+    "observe_many: same as observe for a list of atmospheric parameters (MOOG runs at the same time); used by newton"
+    "method: one of strategies (strategy if None)"
+    "steps: finite-difference steps for newton (fdsteps in setup_converge.py if None)"
+    "callback: function of (iteration, parameters, observables) called after each iteration (e.g., to plot)"
+    "clamp: function that returns the nearest valid atmospheric parameters (e.g., inside the model grid), used if clampgrid"
+    "glob: step globalization, None, 'linesearch' or 'trustregion' (globalization if -1)"
+    "surr: Surrogate of the observables of the star, used to screen the steps (a new one if None and usesurrogate)"
+    "spec: speculative mode (speculative if None, and the runner of MOOG is parallel); the candidates are evaluated with observe_many"
+    "records: JSONL file where the record of each iteration is saved (the history entry, with the parameters and observables)"
+    "Returns the final parameters, quadrature, Jacobian, MoogRun and number of iterations, and the history:"
+    "a list with one dict per iteration (quadr, number of evaluations, MOOG runs and MOOG cache hits, wall time in seconds,"
+    "seconds in each phase; see timing.py)"
+    method = check_strategy(method)
+    if records != None and os.path.isfile(records):
+        os.remove(records)
+    glob = check_globalization(glob)
+    if observe_many == None:
+        def observe_many(points):
+            return [observe(p) for p in points]
+    # finite differences step back from the edges of the grid even if the steps are not clamped
+    fdclamp = clamp
+    if clamp == None or clampgrid == False:
+        def clamp(p):
+            return p
+    if surr == None and usesurrogate == True:
+        surr = Surrogate()
+    if surr != None:
+        # every evaluation goes to the surrogate
+        surr.add(pn, ovec)
+        observe_moog, observe_many_moog = observe, observe_many
+        def observe(p):
+            run = observe_moog(p)
+            surr.add(p, run.ovec)
+            return run
+        def observe_many(points):
+            runs = observe_many_moog(points)
+            for p, run in zip(points, runs):
+                surr.add(p, run.ovec)
+            return runs
+    size = np.array(maxstep, dtype=float)
+
+    quadr = np.linalg.norm(ovec)
+    old_quadr = 6e23
+    counter = 0
+    history = []
+    lam = lmdamping
+    radius = 1. # size of the trust region, in units of maxstep
+    H = None
+    if method in ['badbroyden', 'invbroyden']:
+        H = np.linalg.inv(Jn)
+    if spec == None:
+        # candidates are only worth evaluating together if the runner of MOOG runs them at the same time
+        spec = speculative == True and moognmodels.concurrent() == True
+    # alternative estimate of the Jacobian for the speculative mode: good Broyden update for badbroyden, bad Broyden update (inverse) otherwise
+    Jalt = None; Halt = None
+    if spec == True and method == 'badbroyden':
+        Jalt = Jn.copy()
+    elif spec == True:
+        Halt = np.linalg.inv(Jn)
+    while quadr > tolquadr and abs(old_quadr - quadr) > tolchange and counter < maxiter:
+        t0 = time.time()
+        c0 = list(moognmodels.counts)
+        h0 = moogcache._stats[0]
+        s0 = timing.snapshot()
+
+        # the step
+        if method == 'newton':
+            Jn = fd_jacobian(observe_many, pn, ovec, steps, fdclamp)
+        if H is not None:
+            delta_p = -np.dot(H, ovec)
+        elif method == 'lm':
+            A = np.dot(Jn.T, Jn)
+            delta_p = -np.linalg.solve(A + lam*np.diag(np.diag(A)), np.dot(Jn.T, ovec))
+        else:
+            delta_p = -np.linalg.solve(Jn, ovec)
+        if surr != None and surr.ready():
+            delta_p = surr.propose(pn, ovec, delta_p, clamp)[0]
+        if glob == 'linesearch':
+            delta_p = limit_step(delta_p, size)
+        elif glob == 'trustregion':
+            delta_p = limit_step(delta_p, radius*size)
+        p_new = clamp(pn + delta_p)
+        delta_p = p_new - pn
+        if not np.any(delta_p != 0.):
+            print('-- solver: step blocked by the limits of the model grid')
+            break
+
+        # external stuff: creates an input model for MOOG, runs MOOG and loads its results
+        others = []
+        if spec == True:
+            dp_alt = -np.linalg.solve(Jalt, ovec) if Jalt is not None else -np.dot(Halt, ovec)
+            if glob == 'linesearch':
+                dp_alt = limit_step(dp_alt, size)
+            elif glob == 'trustregion':
+                dp_alt = limit_step(dp_alt, radius*size)
+            points = []
+            for p in [clamp(pn + f*delta_p) for f in specfactors] + [clamp(pn + dp_alt)]:
+                if np.any(p != pn) and not any(np.all(p == q) for q in points):
+                    points.append(p)
+            runs = observe_many(points)
+            best = np.argmin([np.linalg.norm(r.ovec) for r in runs])
+            others = [(points[i], runs[i]) for i in range(len(points)) if i != best]
+            p_new, run_new = points[best], runs[best]
+            delta_p = p_new - pn
+        else:
+            run_new = observe(p_new)
+        ovec_new = run_new.ovec
+        if glob == 'linesearch' and spec == False:
+            nback = 0
+            while np.linalg.norm(ovec_new) > quadr and nback < maxbacktrack:
+                delta_p = 0.5*delta_p
+                p_new = clamp(pn + delta_p)
+                delta_p = p_new - pn
+                run_new = observe(p_new)
+                ovec_new = run_new.ovec
+                nback = nback + 1
+        quadr_new = np.linalg.norm(ovec_new)
+
+        # steps that increase the quadrature are rejected (lm and trustregion); the Jacobian (or its inverse)
+        # is updated with every new point, even a rejected one
+        reject = quadr_new > quadr and (method == 'lm' or glob == 'trustregion')
+        if glob == 'trustregion':
+            J = Jn if H is None else np.linalg.inv(H)
+            predicted = quadr**2 - np.linalg.norm(ovec + np.dot(J, delta_p))**2
+            rho = (quadr**2 - quadr_new**2)/predicted if predicted > 0. else -1.
+            if rho < 0.25:
+                radius = max(0.5*radius, 1./64.)
+            elif rho > 0.75 and np.max(np.abs(delta_p)/(radius*size)) > 0.99:
+                radius = min(2.*radius, 4.)
+        # (in speculative mode, the other candidates first, so that the last update is the one of the kept step)
+        for p_c, run_c in others + [(p_new, run_new)]:
+            if method in ['broyden', 'lm']:
+                Jn = jacobian_update(Jn, pn, p_c, ovec, run_c.ovec)
+            elif method == 'badbroyden':
+                H = bad_broyden_update(H, p_c - pn, run_c.ovec - ovec)
+            elif method == 'invbroyden':
+                H = sherman_morrison_update(H, p_c - pn, run_c.ovec - ovec)
+            if Jalt is not None:
+                Jalt = jacobian_update(Jalt, pn, p_c, ovec, run_c.ovec)
+            elif Halt is not None:
+                Halt = bad_broyden_update(Halt, p_c - pn, run_c.ovec - ovec)
+
+        counter = counter + 1
+        if method == 'lm':
+            lam = lam*10. if quadr_new > quadr else lam/10.
+        if reject == False:
+            old_quadr = quadr
+            pn, ovec, run = p_new, ovec_new, run_new
+            quadr = quadr_new
+
+        history.append({'iter': counter, 'quadr': quadr, 'evals': moognmodels.counts[0] - c0[0],
+                        'moog': moognmodels.counts[1] - c0[1], 'cachehits': moogcache._stats[0] - h0,
+                        'time': time.time() - t0, 'phases': {k: v[0] for k, v in timing.since(s0).items()},
+                        'rejected': reject})
+        if records != None:
+            rec = {'strategy': method, 'params': pn, 'ovec': ovec}
+            rec.update(history[-1])
+            timing.write_record(records, rec)
+
+        # print info about the current iteration
+        print('%7.1e %2i%s' % (quadr, counter, ' (step rejected)' if reject == True else ''))
+        print(delta_p)
+        if callback != None:
+            callback(counter, pn, ovec)
+
+    if H is not None:
+        Jn = np.linalg.inv(H)
+    if surr != None:
+        surr.save()
+    if len(history) > 0:
+        print('-- solver %s: %i iterations, %i evaluations, %i MOOG runs, %.1f s' % (method, counter,
+              sum(h['evals'] for h in history), sum(h['moog'] for h in history), sum(h['time'] for h in history)))
+    return pn, quadr, Jn, run, counter, history
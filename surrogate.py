@@ -0,0 +1,130 @@
+# This module has the surrogate model of the observables: a radial basis function regression over all the
+# atmospheric parameters evaluated so far for a star (and, optionally, in earlier runs of the same star).
+# The solver uses it to choose, among several candidate steps, the one that MOOG is then run for.
+import os
+import hashlib
+from tempfile import mkstemp
+import numpy as np
+from scipy.interpolate import RBFInterpolator
+
+# === USER OPTIONS AREA ===
+
+# folder where the evaluations of each star are kept for later runs (None: only the evaluations of the current run are used)
+global histdir; histdir = os.path.join(os.path.expanduser('~'), '.cache', 'xiru', 'surrogate')
+
+# scales of Teff, logg, [M/H] and vt in the surrogate (differences of about one scale unit give similar changes of the observables)
+global surrscale; surrscale = [100., 0.2, 0.1, 0.2]
+
+# smoothing of the regression (the observables are rounded by MOOG) and largest number of points used (the nearest ones)
+global smoothing; smoothing = 1e-4
+global maxpoints; maxpoints = 60
+
+# multiples of the solver step that are screened, besides the Newton step of the surrogate itself
+global stepfactors; stepfactors = [0.5, 1., 1.5]
+
+# === END OF USER OPTIONS AREA ===
+
+def history_key(*parts):
+    "Name of the shared history of a star (e.g., from the digest of its MOOG input file and the kind of analysis)"
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode())
+    return h.hexdigest()[:32]
+
+class Surrogate:
+    "Surrogate model of the observables of one star"
+    "key: name of the shared history of the star (see history_key); if None, nothing is loaded or saved"
+
+    def __init__(self, key=None):
+        self.key = key
+        self.scale = np.array(surrscale, dtype=float)
+        self.X = np.zeros((0,4))
+        self.Y = np.zeros((0,4))
+        self.nnew = 0
+        self.model = None
+        self.center = None
+        if key != None and histdir != None and os.path.isfile(self.fname()):
+            d = np.load(self.fname())
+            self.X = d['X']; self.Y = d['Y']
+
+    def fname(self):
+        return os.path.join(histdir, self.key + '.npz')
+
+    def add(self, p, ovec):
+        "Adds an evaluation (a point already in the model is replaced)"
+        p = np.asarray(p, dtype=float); ovec = np.asarray(ovec, dtype=float)
+        if self.X.shape[0] > 0:
+            same = np.all(np.abs(self.X - p)/self.scale < 1e-6, axis=1)
+            self.X = self.X[~same]; self.Y = self.Y[~same]
+        self.X = np.vstack((self.X, p)); self.Y = np.vstack((self.Y, ovec))
+        self.nnew = self.nnew + 1
+        self.model = None
+
+    def ready(self):
+        "True if there are enough points for the regression: 5 not all in one hyperplane, for the linear part of the model in 4 dimensions"
+        "(e.g., points that all have [M/H] clamped at an edge of the grid are not enough)"
+        if self.X.shape[0] < 5:
+            return False
+        return np.linalg.matrix_rank((self.X - self.X.mean(axis=0))/self.scale) == 4
+
+    def fit(self, p):
+        "Fits the model with the maxpoints points nearest to p (refitted only after new points or a distant p)"
+        "Raises LinAlgError if these points are degenerate (see ready)"
+        p = np.asarray(p, dtype=float)
+        if self.model != None and self.X.shape[0] <= maxpoints:
+            return
+        if self.model != None and np.all(self.center == p):
+            return
+        d = np.sqrt((((self.X - p)/self.scale)**2).sum(axis=1))
+        near = np.argsort(d)[:maxpoints]
+        self.model = None
+        self.model = RBFInterpolator(self.X[near]/self.scale, self.Y[near], kernel='thin_plate_spline', degree=1, smoothing=smoothing)
+        self.center = p
+
+    def predict(self, points):
+        "Predicted observables at the points (N x 4)"
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        self.fit(points[0])
+        return self.model(points/self.scale)
+
+    def jacobian(self, p):
+        "Jacobian of the surrogate at p (central differences)"
+        h = 0.1*self.scale
+        dp = np.concatenate((np.diag(h), -np.diag(h)))
+        y = self.predict(np.vstack((p, p + dp)))[1:]
+        return ((y[:4] - y[4:])/(2*h)).T
+
+    def propose(self, pn, ovec, delta_p, clamp=None):
+        "Chooses the step for the next MOOG run: the solver step delta_p times each of stepfactors, or the Newton step of the surrogate"
+        "clamp: function that returns the nearest valid atmospheric parameters"
+        "Returns the chosen step and the predicted quadrature after it (delta_p and None if the surrogate cannot be fitted)"
+        steps = [f*delta_p for f in stepfactors]
+        try:
+            steps.append(-np.linalg.solve(self.jacobian(pn), ovec))
+        except np.linalg.LinAlgError:
+            pass
+        points = np.array([p if clamp == None else clamp(p) for p in [pn + s for s in steps]])
+        try:
+            quadr = np.linalg.norm(self.predict(points), axis=1)
+        except np.linalg.LinAlgError:
+            # degenerate points near pn: the solver step is kept
+            return delta_p, None
+        best = np.argmin(quadr)
+        return points[best] - pn, quadr[best]
+
+    def save(self):
+        "Saves the evaluations to the shared history of the star (merged with those saved by other runs in the meantime)"
+        if self.key == None or histdir == None or self.nnew == 0:
+            return
+        os.makedirs(histdir, exist_ok=True)
+        if os.path.isfile(self.fname()):
+            d = np.load(self.fname())
+            X = np.vstack((d['X'], self.X)); Y = np.vstack((d['Y'], self.Y))
+            X, k = np.unique(X, axis=0, return_index=True)
+            self.X, self.Y = X, Y[k]
+        fd, tmp = mkstemp(dir=histdir, suffix='.tmp')
+        f = os.fdopen(fd, 'wb')
+        np.savez(f, X=self.X, Y=self.Y)
+        f.close()
+        os.replace(tmp, self.fname())
+        self.nnew = 0
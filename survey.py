@@ -0,0 +1,129 @@
+# Runs Xiru for many stars at once, each star in a separate process
+# The stars are listed in a manifest file (CSV or TSV) with a header line and the columns:
+# star: name of the star (also the name of the folder where its results are saved)
+# lines: MOOG lines_in file of the star
+# teff logg metal vt: first guess of the atmospheric parameters
+# mode: standard, alpha (standard with the Salaris correction) or differential
+# jacobian (optional): initial Jacobian, cmatrix or fd (see setup_converge.py)
+# solver (optional): solver strategy (see solver.py)
+# File names are relative to the folder of the manifest, where the MOOG input file (batch.par) must be.
+# In differential mode, ref.par and refatm must be in that folder as well (see README).
+#
+# $ python survey.py stars.csv -n 8
+import os
+import csv
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+from argparse import ArgumentParser
+import numpy as np
+import moogcache
+from differential import reference_star
+from xiru import solve_star
+
+# columns of the results table
+global rescols; rescols = ['star', 'mode', 'teff', 'logg', 'metal', 'vt', 'e_teff', 'e_logg', 'e_metal', 'e_vt', 'niter', 'nevals', 'nmoog', 'quadr', 'status']
+
+def read_manifest(fin):
+    "Reads the list of stars to be analysed"
+    "Returns a list of dicts, one per star, with the manifest columns"
+    f = open(fin, 'r', newline='')
+    t = [line for line in f if line.strip() != '' and not line.startswith('#')]
+    f.close()
+    delimiter = '\t' if (fin.endswith('.tsv') or '\t' in t[0]) else ','
+    stars = []
+    for row in csv.DictReader(t, delimiter=delimiter):
+        row = {k.strip(): v.strip() for k, v in row.items()}
+        row['p0'] = [float(row['teff']), float(row['logg']), float(row['metal']), float(row['vt'])]
+        row['mode'] = row.get('mode', 'standard') or 'standard'
+        if row['mode'] not in ['standard', 'alpha', 'differential']:
+            print('Survey: invalid mode %s for star %s!' % (row['mode'], row['star']))
+            raise SystemExit()
+        stars.append(row)
+    return stars
+
+def run_star(star, workdir, outdir, par='batch.par', scratch=None, ref=None):
+    "Analyses one star (runs in a worker process)"
+    "ref: observables of the reference star for differential analysis (computed by the worker if None)"
+    "The text output of the run (xiru.log), MOOG's standard_out of the last run and the result files are saved in outdir/<star name>"
+    "Returns a dict with the columns of the results table"
+    os.chdir(workdir)
+    stardir = os.path.join(outdir, star['star'])
+    os.makedirs(stardir, exist_ok=True)
+    res = {'star': star['star'], 'mode': star['mode'], 'status': 'ok'}
+    flog = open(os.path.join(stardir, 'xiru.log'), 'w')
+    try:
+        r = solve_star(star['p0'], par, star['mode'] == 'differential', star['mode'] == 'alpha', star.get('jacobian') or None,
+                       star.get('solver') or None, ref, outdir=stardir, log=flog, lines=star['lines'], scratch=scratch)
+        res.update(zip(rescols[2:6], r.params))
+        res.update(zip(rescols[6:10], r.errors))
+        res['niter'] = r.niter
+        # evaluations of the whole analysis (initialisation included), the main cost of the analysis
+        res['nevals'] = r.nevals
+        res['nmoog'] = r.nmoog
+        res['quadr'] = r.quadr
+    except Exception as e:
+        # e.g., parameters outside the model grid (RuntimeError from solve_star, with the reason)
+        # (only the first line, so that the results table keeps one row per star)
+        res['status'] = 'failed: %s' % ((str(e) or type(e).__name__).splitlines()[0])
+    finally:
+        flog.close()
+    return res
+
+def write_results(results, fout):
+    "Saves the consolidated results table (tab-separated)"
+    f = open(fout, 'w')
+    f.write('\t'.join(rescols) + '\n')
+    for res in results:
+        s = []
+        for k in rescols:
+            v = res.get(k, np.nan)
+            if isinstance(v, str):
+                s.append(v)
+            elif k in ['teff', 'e_teff']:
+                s.append('%.1f' % v)
+            elif k in ['niter', 'nevals', 'nmoog']:
+                s.append('%i' % v if v == v else 'nan')
+            elif k == 'quadr':
+                s.append('%.1e' % v)
+            else:
+                s.append('%.4f' % v)
+        f.write('\t'.join(s) + '\n')
+    f.close()
+
+def run_survey(manifest, nworkers=None, outdir='results', par='batch.par', scratch=None, fout=None):
+    "Analyses all stars of the manifest with a pool of nworkers processes (number of CPUs if None)"
+    "Returns the list of results, in the same order as the manifest, and saves them to fout (outdir/results.tsv if None)"
+    workdir = os.path.dirname(os.path.abspath(manifest))
+    outdir = os.path.join(workdir, outdir)
+    os.makedirs(outdir, exist_ok=True)
+    if fout == None:
+        fout = os.path.join(outdir, 'results.tsv')
+    stars = read_manifest(manifest)
+    # the reference star is the same for all differential analyses: it runs only once, here
+    ref = None
+    if any(star['mode'] == 'differential' for star in stars):
+        try:
+            ref = reference_star(os.path.join(workdir, 'ref.par'), os.path.join(workdir, 'refatm'))
+        except (Exception, SystemExit) as e:
+            print('Survey: reference star failed: %s' % (str(e) or type(e).__name__))
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        futures = [pool.submit(run_star, star, workdir, outdir, par, scratch, ref) for star in stars]
+        results = []
+        for star, fut in zip(stars, futures):
+            res = fut.result()
+            print('%-20s %s' % (star['star'], res['status']))
+            results.append(res)
+    write_results(results, fout)
+    return results
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('manifest', help='CSV/TSV file with columns star, lines, teff, logg, metal, vt, mode')
+    parser.add_argument('-n', '--nworkers', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-o', '--outdir', default='results', help='Folder for the results, relative to the manifest folder')
+    parser.add_argument('-p', '--par', default='batch.par', help='MOOG input file used as template for all stars')
+    parser.add_argument('-s', '--scratch', default=None, help='Folder for the scratch directories (default: system temporary folder)')
+    args = parser.parse_args()
+    # hit rate of the MOOG cache (reference star), printed at exit
+    atexit.register(moogcache.report)
+    run_survey(args.manifest, args.nworkers, args.outdir, args.par, args.scratch)
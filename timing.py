@@ -0,0 +1,86 @@
+# This module has the timers of the phases of an analysis (model interpolation, MOOG, parsing, etc.)
+# and the optional machine-readable records of the iterations and profiling of a run
+import time
+import json
+import cProfile
+from contextlib import contextmanager
+import numpy as np
+
+# === USER OPTIONS AREA ===
+
+# if True, a record of each iteration (parameters, observables, quadrature, phase timings, MOOG cache hits)
+# is saved as one JSON line in iterations.jsonl, in the folder of the results
+global jsonl; jsonl = False
+
+# if True, the run is profiled with cProfile and the statistics are saved in xiru.prof, in the folder of the results
+# (python -m pstats xiru.prof)
+global profile; profile = False
+
+# === END OF USER OPTIONS AREA ===
+
+# seconds and number of calls of each phase in this process
+global _totals; _totals = {}
+
+@contextmanager
+def phase(name):
+    "Times the code in a with block as part of the phase name"
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        t = _totals.setdefault(name, [0., 0])
+        t[0] += time.perf_counter() - t0
+        t[1] += 1
+
+def snapshot():
+    "Current totals, to be given to since() or summary() later"
+    return {k: list(v) for k, v in _totals.items()}
+
+def since(snap):
+    "Seconds and number of calls of each phase after the snapshot"
+    d = {}
+    for k, v in _totals.items():
+        v0 = snap.get(k, [0., 0])
+        if v[1] > v0[1]:
+            d[k] = [v[0] - v0[0], v[1] - v0[1]]
+    return d
+
+def summary(snap=None, title='Timing'):
+    "Prints the time spent in each phase after the snapshot (since the start of the process if None)"
+    d = since({} if snap == None else snap)
+    if len(d) == 0:
+        return
+    print('\n%s:' % title)
+    for k in sorted(d, key=lambda k: -d[k][0]):
+        print('-- %-12s %8.2f s %6i calls' % (k, d[k][0], d[k][1]))
+
+def jsonable(x):
+    "Converts numpy values in x to plain Python, for json"
+    if isinstance(x, dict):
+        return {k: jsonable(v) for k, v in x.items()}
+    elif isinstance(x, (list, tuple, np.ndarray)):
+        return [jsonable(v) for v in x]
+    elif isinstance(x, np.generic):
+        return x.item()
+    return x
+
+def write_record(fout, rec):
+    "Appends a record to a JSONL file"
+    f = open(fout, 'a')
+    f.write(json.dumps(jsonable(rec)) + '\n')
+    f.close()
+
+def start_profile():
+    "Starts cProfile if profile is True; returns the profiler (None otherwise)"
+    if profile == False:
+        return None
+    prof = cProfile.Profile()
+    prof.enable()
+    return prof
+
+def stop_profile(prof, fout='xiru.prof'):
+    "Stops the profiler returned by start_profile and saves its statistics (to fout, if not None)"
+    if prof != None:
+        prof.disable()
+        if fout != None:
+            prof.dump_stats(fout)
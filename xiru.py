@@ -1,23 +1,146 @@
+# Xiru: spectroscopic atmospheric parameters from the excitation/ionisation balance of Fe I/II lines with MOOG
+#
+# Command line (from the folder of the star, see README):
+# $ python xiru.py [Teff] [logg] [metal] [micro] [-d] [-a] [-p] [-j ...] [-s ...]
+#
+# From Python:
+# >>> from xiru import solve_star
+# >>> res = solve_star([4300., 1.6, -0.5, 1.7], par='arcturus/batch.par')
+# >>> res.params, res.errors
+import os
+import sys
+import atexit
+from contextlib import redirect_stdout
+import numpy as np
+import matplotlib.pyplot as plt
 from setup_converge import initial_options, std_anal_init
 from main_routines_conv import converge_main, final_remarks
 from differential import diff_main
 from converge_errors import make_errors
+from runcontext import RunContext
+import moognmodels
+import moogcache
+import solver
+import timing
 
-# interprets command-line arguments
-par0, makeplot, argsalpha, differential = initial_options()
+class StarResult:
+    "Results of the analysis of one star, as returned by solve_star"
+    "params: atmospheric parameters [Teff, logg, [M/H], vt]; errors: their internal uncertainties"
+    "jacobian: final Jacobian; observables: final observables (with [alpha/Fe] and [Fe/H] if alpha); quadr: their quadrature"
+    "converged: True if quadr is below tolquadr (solver.py)"
+    "niter: number of iterations; nevals, nmoog: evaluations (MOOG cache hits included) and MOOG runs of the whole analysis"
+    "history: one dict per iteration (see solver.solve); timing: seconds and number of calls of each phase (see timing.py)"
+    "run: MoogRun at the final parameters (the lines and averages of MOOG's summary_out)"
 
-if differential == True:
-    argsalpha = False # forces solar-scaled atmosphere for differential analysis
-    # runs differential analysis:
-    pn, qdr, final_jac = diff_main(par0, makeplot)
-else:
-    # creates x0 and x1 vectors; creates Jacobian
-    p1, Jn, ovec, pn_init, quadr = std_anal_init(par0, argsalpha)
-    # main algorithm for standard analysis
-    pn, qdr, final_jac = converge_main(p1, Jn, ovec, pn_init, quadr, makeplot, argsalpha)
+    def __init__(self, params, errors, jacobian, observables, quadr, niter, nevals, nmoog, history, timing, run, differential, alpha):
+        self.params = params
+        self.errors = errors
+        self.jacobian = jacobian
+        self.observables = observables
+        self.quadr = quadr
+        self.converged = quadr <= solver.tolquadr
+        self.niter = niter
+        self.nevals = nevals
+        self.nmoog = nmoog
+        self.history = history
+        self.timing = timing
+        self.run = run
+        self.differential = differential
+        self.alpha = alpha
 
-# calculates internal uncertainties
-datm = make_errors(final_jac, diff_analysis=differential)
+class OutputTail:
+    "Text output of an analysis: passed on to log (if not None), with its end kept for the error messages of solve_star"
 
-# prints information; saves the results; plots iterations if requested
-final_remarks(pn, qdr, final_jac, makeplot, argsalpha, differential, datm)
+    def __init__(self, log=None):
+        self.log = log
+        self.text = ''
+
+    def write(self, s):
+        if self.log != None:
+            self.log.write(s)
+        self.text = (self.text + s)[-2000:]
+        return len(s)
+
+    def flush(self):
+        if self.log != None:
+            self.log.flush()
+
+    def last(self):
+        "Last non-empty line of the output"
+        lines = [line for line in self.text.splitlines() if line.strip() != '']
+        return lines[-1].strip() if len(lines) > 0 else ''
+
+def solve_star(p0, par='batch.par', differential=False, alpha=False, jinit=None, method=None, ref=None,
+               outdir=None, log=None, makeplot=False, lines=None, scratch=None):
+    "Analyses one star and returns a StarResult"
+    "p0: first guess of the atmospheric parameters [Teff, logg, [M/H], vt]"
+    "par: MOOG input file of the star (file names in it are relative to its folder; ref.par and refatm are taken from"
+    "the current folder in differential analysis, unless ref is given)"
+    "differential, alpha: differential analysis, or standard analysis with the Salaris correction (as -d and -a)"
+    "jinit, method: initial Jacobian and solver strategy (as -j and -s; jacinit and strategy if None)"
+    "ref: observables of the reference star, as returned by differential.reference_star (computed here if None)"
+    "outdir: folder where the result files (atmparam, unc_atmparam, Jacobian, feplot.png, ...) are saved; None: no files"
+    "log: file object that receives the text output of the analysis (e.g., sys.stdout); None: no text output"
+    "makeplot: if True, the iterations are plotted (shown by the caller, with plt.show())"
+    "lines: line list used instead of the lines_in of par; scratch: folder for the scratch directories (system temporary folder if None)"
+    "Raises RuntimeError, with the reason as message, if the analysis fails (e.g., parameters outside the grid, MOOG errors,"
+    "a singular Jacobian, a species missing in the output of MOOG, unreadable input files)"
+    if differential == True:
+        alpha = False # forces solar-scaled atmosphere for differential analysis
+    if outdir != None:
+        os.makedirs(outdir, exist_ok=True)
+    ctx = RunContext(par, scratch=scratch, outdir=outdir, lines=lines, save=outdir != None)
+    flog = OutputTail(log)
+    c0 = list(moognmodels.counts)
+    snap = timing.snapshot()
+    prof = timing.start_profile()
+    try:
+        with redirect_stdout(flog):
+            if differential == True:
+                pn, qdr, final_jac, run, niter, history = diff_main(p0, makeplot, ctx=ctx, jinit=jinit, ref=ref, method=method)
+            else:
+                # creates x0 and x1 vectors; creates Jacobian
+                p1, Jn, ovec, pn_init, quadr, run = std_anal_init(p0, alpha, ctx=ctx, jinit=jinit)
+                # main algorithm for standard analysis
+                pn, qdr, final_jac, run, niter, history = converge_main(p1, Jn, ovec, pn_init, quadr, makeplot, alpha, run, ctx, method)
+
+            # calculates internal uncertainties
+            # (the MoogRun of the final iteration is passed on, so MOOG's output is not parsed again)
+            datm = make_errors(final_jac, run, diff_analysis=differential, ctx=ctx, ref=ref)
+
+            # prints information; saves the results if requested
+            final_ovec = final_remarks(pn, qdr, final_jac, False, alpha, differential, datm, run, ctx)
+
+            # where the time went (model interpolation, MOOG, parsing, ...)
+            timing.summary(snap)
+    except SystemExit as e:
+        # the modules of Xiru stop with SystemExit, after printing the reason (or with the reason as argument)
+        msg = str(e.code) if isinstance(e.code, str) else flog.last()
+        raise RuntimeError(msg or 'analysis failed') from e
+    except (np.linalg.LinAlgError, KeyError, ValueError, OSError) as e:
+        # other failures of the analysis (singular Jacobian, no Fe II lines in summary_out, missing files, ...)
+        raise RuntimeError('%s: %s' % (type(e).__name__, e)) from e
+    finally:
+        timing.stop_profile(prof, ctx.output('xiru.prof'))
+        # MOOG's standard_out of the last run is kept with the results (also when the analysis failed)
+        ctx.save_log()
+        ctx.cleanup()
+    return StarResult(pn, datm, final_jac, final_ovec, qdr, niter, moognmodels.counts[0] - c0[0], moognmodels.counts[1] - c0[1],
+                      history, timing.since(snap), run, differential, alpha)
+
+if __name__ == "__main__":
+    # hit rate of the MOOG cache, printed at exit
+    atexit.register(moogcache.report)
+
+    # interprets command-line arguments
+    par0, makeplot, argsalpha, differential, jinit, method = initial_options()
+
+    # MOOG runs in a scratch directory with its own copy of batch.par; results are saved in the current folder
+    try:
+        solve_star(par0, 'batch.par', differential, argsalpha, jinit, method, outdir='.', log=sys.stdout, makeplot=makeplot)
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+
+    # plots iterations if requested
+    if makeplot == True:
+        plt.show()